@@ -8,11 +8,15 @@ from rpython.rlib.runicode import str_decode_utf_8
 from rply.token import BaseBox
 from soda import bytecode
 from soda.errors import sodaError
-from soda.objects import SodaInt, SodaString, SodaFunction, SodaDummy
+from soda.optimizer import optimizer
+from soda.objects import SodaString, SodaFunction, SodaSmallInt, newbigint
+from soda.objects import TRUE, FALSE, utf8length
 
 
 class Node(BaseBox):
-    pass
+    # whether running the node can assign the variable name from package
+    def assigns(self, name, package):
+        return False
 
 
 class List(Node):
@@ -33,15 +37,22 @@ class List(Node):
 
 class String(Node):
     def __init__(self, value, package, line, col):
-        string = value.getstr()
-        iden, trash = str_decode_utf_8(string, len(string), "strict", True)
-        self.value = iden
+        self.value = value.getstr()
         self.package = package
         self.line = line
         self.col = col
 
     def compile(self, compiler):
-        ss = SodaString(self.value)
+        if self.value == "true":
+            ss = TRUE
+        elif self.value == "false":
+            ss = FALSE
+        else:
+            size = utf8length(self.value)
+            if size == -1:
+                sodaError(self.package, self.line, self.col,
+                          "string is not valid UTF-8")
+            ss = SodaString(self.value, size)
         compiler.emit(bytecode.LOAD_CONST, compiler.register_constant(ss),
                       self.package, self.line, self.col)
 
@@ -64,7 +75,7 @@ class Integer(Node):
         self.col = col
 
     def compile(self, compiler):
-        si = SodaInt(self.value)
+        si = newbigint(self.value)
         compiler.emit(bytecode.LOAD_CONST, compiler.register_constant(si),
                       self.package, self.line, self.col)
 
@@ -93,18 +104,24 @@ class If(Node):
         self.col = col
 
     def compile(self, compiler):
+        body = bytecode.Block()
+        end = bytecode.Block()
         self.cond.compile(compiler)
-        compiler.emit(bytecode.J_IF_TRUE, 0, self.package,
-                      self.line, self.col)
-        jumppos = len(compiler.stack) - 1
+        compiler.emit_jump(bytecode.J_IF_TRUE, body, self.package,
+                           self.line, self.col)
         self.elsestatement.compile(compiler)
-        compiler.emit(bytecode.JUMP, 0, self.package,
-                      self.line, self.col)
-        compiler.stack[jumppos] = len(compiler.stack)
-        jumppos = len(compiler.stack) - 1
+        compiler.emit_jump(bytecode.JUMP, end, self.package,
+                           self.line, self.col)
+        compiler.use_block(body)
         for statement in self.body:
             statement.compile(compiler)
-        compiler.stack[jumppos] = len(compiler.stack)
+        compiler.use_block(end)
+
+    def assigns(self, name, package):
+        for statement in self.body:
+            if statement.assigns(name, package):
+                return True
+        return self.elsestatement.assigns(name, package)
 
 
 class For(Node):
@@ -118,21 +135,109 @@ class For(Node):
         self.col = col
 
     def compile(self, compiler):
+        if self.counted():
+            self.compile_counted(compiler)
+            return
+        head = bytecode.Block()
+        end = bytecode.Block()
         self.init.compile(compiler)
-        initpos = len(compiler.stack)
+        compiler.use_block(head)
         self.cond.compile(compiler)
-        compiler.emit(bytecode.J_IF_FALSE, 0, self.package,
-                      self.line, self.col)
-        postpos = len(compiler.stack) - 1
+        compiler.emit_jump(bytecode.J_IF_FALSE, end, self.package,
+                           self.line, self.col)
+        compiler.push_loop(end)
         for statement in self.body:
             statement.compile(compiler)
         self.post.compile(compiler)
-        compiler.emit(bytecode.JUMP, initpos, self.package,
-                      self.line, self.col)
-        compiler.stack[postpos] = len(compiler.stack)
-        for i in range(initpos, len(compiler.stack)):
-            if compiler.stack[i] == -3:
-                compiler.stack[i] = len(compiler.stack)
+        compiler.pop_loop()
+        compiler.emit_jump(bytecode.JUMP, head, self.package,
+                           self.line, self.col)
+        compiler.use_block(end)
+
+    # whether the loop is for i := a; i < b; i := i + 1 with a body that
+    # never assigns i, so that i only ever changes by one at the end
+    def counted(self):
+        if optimizer.level < 1:
+            return False
+        init = self.init
+        cond = self.cond
+        post = self.post
+        if not isinstance(init, Assignment) or\
+           not isinstance(cond, BinOp) or not isinstance(post, Assignment):
+            return False
+        counter = init.single()
+        if counter is None or cond.operator != "<":
+            return False
+        name = counter.value
+        package = unicode(counter.package)
+        if not isvariable(cond.left, name, package):
+            return False
+        step = post.single()
+        if step is None or step.value != name or\
+           unicode(step.package) != package:
+            return False
+        incr = post.exprs.get()[0]
+        if not isinstance(incr, BinOp) or incr.operator != "+":
+            return False
+        if not (isvariable(incr.left, name, package) and isone(incr.right)
+                or isone(incr.left) and isvariable(incr.right, name,
+                                                     package)):
+            return False
+        for statement in self.body:
+            if statement.assigns(name, package):
+                return False
+        return True
+
+    # the counter is checked and stepped by FOR_LT and FOR_INC, which
+    # work on machine ints and only fall back to the generic comparison
+    # and addition when the counter or the bound is not one
+    def compile_counted(self, compiler):
+        init = self.init
+        cond = self.cond
+        post = self.post
+        assert isinstance(init, Assignment)
+        assert isinstance(cond, BinOp)
+        assert isinstance(post, Assignment)
+        counter = init.single()
+        assert counter is not None
+        incr = post.exprs.get()[0]
+        assert isinstance(incr, BinOp)
+        head = bytecode.Block()
+        end = bytecode.Block()
+        init.compile(compiler)
+        idx = compiler.register_variable(counter.value, counter.package)
+        compiler.use_block(head)
+        cond.right.compile(compiler)
+        compiler.emit_jump(bytecode.FOR_LT, end, cond.package, cond.line,
+                           cond.col, idx)
+        compiler.push_loop(end)
+        for statement in self.body:
+            statement.compile(compiler)
+        compiler.pop_loop()
+        compiler.emit_jump(bytecode.FOR_INC, head, incr.package, incr.line,
+                           incr.col, idx)
+        compiler.use_block(end)
+
+    def assigns(self, name, package):
+        if self.init.assigns(name, package) or\
+           self.post.assigns(name, package):
+            return True
+        for statement in self.body:
+            if statement.assigns(name, package):
+                return True
+        return False
+
+
+def isvariable(node, name, package):
+    return isinstance(node, Variable) and node.value == name and\
+        node.reference == package
+
+
+def isone(node):
+    if not isinstance(node, Integer):
+        return False
+    value = newbigint(node.value)
+    return isinstance(value, SodaSmallInt) and value.intval == 1
 
 
 class While(Node):
@@ -144,19 +249,25 @@ class While(Node):
         self.col = col
 
     def compile(self, compiler):
-        initpos = len(compiler.stack)
+        head = bytecode.Block()
+        end = bytecode.Block()
+        compiler.use_block(head)
         self.cond.compile(compiler)
-        compiler.emit(bytecode.J_IF_FALSE, 0, self.package,
-                      self.line, self.col)
-        postpos = len(compiler.stack) - 1
+        compiler.emit_jump(bytecode.J_IF_FALSE, end, self.package,
+                           self.line, self.col)
+        compiler.push_loop(end)
         for statement in self.body:
             statement.compile(compiler)
-        compiler.emit(bytecode.JUMP, initpos, self.package,
-                      self.line, self.col)
-        compiler.stack[postpos] = len(compiler.stack)
-        for i in range(initpos, len(compiler.stack)):
-            if compiler.stack[i] == -3:
-                compiler.stack[i] = len(compiler.stack)
+        compiler.pop_loop()
+        compiler.emit_jump(bytecode.JUMP, head, self.package,
+                           self.line, self.col)
+        compiler.use_block(end)
+
+    def assigns(self, name, package):
+        for statement in self.body:
+            if statement.assigns(name, package):
+                return True
+        return False
 
 
 class Iterate(Node):
@@ -171,22 +282,38 @@ class Iterate(Node):
         self.col = col
 
     def compile(self, compiler):
-        initpos = len(compiler.stack)
+        head = bytecode.Block()
+        brk = bytecode.Block()
+        end = bytecode.Block()
         self.expr.compile(compiler)
-        compiler.emit(bytecode.ITERATE, 0, self.package,
+        compiler.emit(bytecode.GET_ITER, 0, self.package,
                       self.line, self.col)
-        postpos = len(compiler.stack) - 1
+        compiler.use_block(head)
+        compiler.emit_jump(bytecode.ITERATE, end, self.package,
+                           self.line, self.col)
         compiler.emit(bytecode.STORE_VAR,
                       compiler.register_variable(self.value, self.package),
                       self.package, self.line, self.col)
+        compiler.push_loop(brk)
         for statement in self.body:
             statement.compile(compiler)
-        compiler.emit(bytecode.JUMP, initpos, self.package,
+        compiler.pop_loop()
+        compiler.emit_jump(bytecode.JUMP, head, self.package,
+                           self.line, self.col)
+        # a break leaves the iterator on the stack, so it exits through
+        # a drop that an exhausted ITERATE skips
+        compiler.use_block(brk)
+        compiler.emit(bytecode.DROP_CONST, 0, self.package,
                       self.line, self.col)
-        compiler.stack[postpos] = len(compiler.stack)
-        for i in range(initpos, len(compiler.stack)):
-            if compiler.stack[i] == -3:
-                compiler.stack[i] = len(compiler.stack)
+        compiler.use_block(end)
+
+    def assigns(self, name, package):
+        if self.value == name and unicode(self.package) == package:
+            return True
+        for statement in self.body:
+            if statement.assigns(name, package):
+                return True
+        return False
 
 
 class Break(Node):
@@ -196,8 +323,7 @@ class Break(Node):
         self.col = col
 
     def compile(self, compiler):
-        compiler.emit(bytecode.JUMP, -3,
-                      self.package, self.line, self.col)
+        compiler.emit_break(self.package, self.line, self.col)
 
 
 class Variable(Node):
@@ -298,6 +424,9 @@ class RegisterVariable(Node):
                       compiler.register_variable(self.value, self.package),
                       self.package, self.line, self.col)
 
+    def assigns(self, name, package):
+        return self.value == name and unicode(self.package) == package
+
 
 class Assignment(Node):
     def __init__(self, idens, exprs, package, line, col):
@@ -315,6 +444,22 @@ class Assignment(Node):
         for iden in self.idens.get():
             iden.compile(compiler)
 
+    def assigns(self, name, package):
+        for iden in self.idens.get():
+            if iden.assigns(name, package):
+                return True
+        return False
+
+    # the variable assigned when this assigns one plain variable
+    def single(self):
+        idens = self.idens.get()
+        if len(idens) != 1:
+            return None
+        iden = idens[0]
+        if not isinstance(iden, RegisterVariable):
+            return None
+        return iden
+
 
 class BinOp(Node):
     def __init__(self, operator, left, right, package, line, col):
@@ -326,11 +471,28 @@ class BinOp(Node):
         self.col = col
 
     def compile(self, compiler):
+        if self.operator == "&" or self.operator == "|":
+            self.compile_shortcircuit(compiler)
+            return
         self.right.compile(compiler)
         self.left.compile(compiler)
         compiler.emit(bytecode.BINOP_CODE[self.operator], 0,
                       self.package, self.line, self.col)
 
+    # the left operand decides the result on its own whenever it is
+    # false for & or true for |, and then the right one is never run
+    def compile_shortcircuit(self, compiler):
+        self.left.compile(compiler)
+        if self.operator == "&":
+            code = bytecode.J_IF_FALSE_OR_POP
+        else:
+            code = bytecode.J_IF_TRUE_OR_POP
+        end = bytecode.Block()
+        compiler.emit_jump(code, end, self.package, self.line, self.col)
+        self.right.compile(compiler)
+        compiler.emit(bytecode.BOOL, 0, self.package, self.line, self.col)
+        compiler.use_block(end)
+
 
 class UnOp(Node):
     def __init__(self, operator, operand, package, line, col):
@@ -364,15 +526,7 @@ class Function(Node):
         function = SodaFunction(name=self.name, arity=len(self.params),
                                 compiler=self.compiler, package=self.package,
                                 line=self.line, col=self.col)
-        compiler.register_function(function)
-        for constant in compiler.constants:
-            if isinstance(constant, SodaFunction):
-                self.compiler.register_function(constant)
-        sd = SodaDummy()
-        for i in range(0, function.arity):
-            self.compiler.emit(bytecode.LOAD_CONST,
-                               self.compiler.register_constant(sd),
-                               self.package, self.line, self.col)
+        bytecode.symbols.declare(function)
         for param in self.params:
             assert isinstance(param, RegisterVariable)
             if param.value == unicode("vargs"):
@@ -381,10 +535,16 @@ class Function(Node):
                               "vargs must be final parameter in "
                               "function declaration")
                 function.isvariadic = True
-            param.compile(self.compiler)
+            if param.value + unicode(param.package) in self.compiler.variables:
+                sodaError(param.package, param.line, param.col,
+                          "duplicate parameter \"%s\" in function "
+                          "declaration" % param.value.encode("utf-8"))
+            self.compiler.register_variable(param.value, param.package)
+        self.compiler.numparams = len(self.params)
         for statement in self.body:
             statement.compile(self.compiler)
         self.returnstatement.compile(self.compiler)
+        bytecode.symbols.declared.append(function)
 
 
 class Call(Node):
@@ -406,17 +566,8 @@ class Call(Node):
     def compile(self, compiler):
         for expr in self.exprlist:
             expr.compile(compiler)
-        idx = compiler.functions.get(self.name + self.reference, -1)
-        if not idx == -1:
-            function = compiler.constants[idx]
-            if not function.isvariadic:
-                if not len(self.exprlist) == function.arity:
-                    idx = -2
-            else:
-                if not len(self.exprlist) >= function.arity - 1:
-                    idx = -2
-        compiler.emit(bytecode.CALL, idx,
-                      self.package, self.line, self.col)
+        compiler.emit_call(self.name + self.reference, len(self.exprlist),
+                           self.package, self.line, self.col)
 
 
 class ReturnStatement(Node):
@@ -5,9 +5,8 @@
 # compiler for soda
 
 from soda.errors import sodaError
-from rpython.rlib.rbigint import rbigint
-from rpython.rlib.runicode import str_decode_utf_8
-from soda.objects import SodaArray, SodaString, SodaInt
+from soda.objects import SodaArray, SodaString, SodaFunction, SodaInt
+from soda.objects import newint, newchar, charwidth
 
 DROP_CONST = 0
 LOAD_CONST = 1
@@ -28,8 +27,6 @@ GT = 15
 LT = 16
 GE = 17
 LE = 18
-AND = 19
-OR = 20
 NEG = 21
 NOT = 22
 RETURN = 23
@@ -44,6 +41,74 @@ LEN = 31
 CHARS = 32
 WORDS = 33
 LINES = 34
+PACK_VARGS = 35
+GET_ITER = 36
+
+# quickened variants of the binary opcodes, rewritten in place once a
+# site has seen its operand types
+ADD_II = 37
+SUB_II = 38
+MUL_II = 39
+DIV_II = 40
+MOD_II = 41
+POW_II = 42
+EQ_II = 43
+NE_II = 44
+GT_II = 45
+LT_II = 46
+GE_II = 47
+LE_II = 48
+EQ_SS = 49
+NE_SS = 50
+GT_SS = 51
+LT_SS = 52
+GE_SS = 53
+LE_SS = 54
+
+J_IF_FALSE_OR_POP = 55
+J_IF_TRUE_OR_POP = 56
+BOOL = 57
+
+# superinstructions fused from common sequences by the optimizer
+INC_VAR = 58
+LOAD_VARS = 59
+INDEX_VAR = 60
+J_UNLESS_EQ = 61
+J_UNLESS_NE = 62
+J_UNLESS_GT = 63
+J_UNLESS_LT = 64
+J_UNLESS_GE = 65
+J_UNLESS_LE = 66
+
+# counted loops; both carry the counter and their jump target
+FOR_LT = 67
+FOR_INC = 68
+
+# statically typed variants emitted where the optimizer has proven the
+# operand types; unlike the quickened ones they never check them
+ADD_INT = 69
+SUB_INT = 70
+MUL_INT = 71
+DIV_INT = 72
+MOD_INT = 73
+POW_INT = 74
+EQ_INT = 75
+NE_INT = 76
+GT_INT = 77
+LT_INT = 78
+GE_INT = 79
+LE_INT = 80
+EQ_STR = 81
+NE_STR = 82
+GT_STR = 83
+LT_STR = 84
+GE_STR = 85
+LE_STR = 86
+NEG_INT = 87
+
+# superinstructions that need two operands carry both in their argument
+PACK_SHIFT = 16
+PACK_MASK = (1 << PACK_SHIFT) - 1
 
 BINOP_CODE = {
     "+": ADD,
@@ -59,9 +124,86 @@ BINOP_CODE = {
     "<": LT,
     ">": GT,
     "<=": LE,
-    ">=": GE,
-    "&": AND,
-    "|": OR,
+    ">=": GE
+}
+
+INT_VARIANT = {
+    ADD: ADD_II,
+    SUB: SUB_II,
+    MUL: MUL_II,
+    DIV: DIV_II,
+    MOD: MOD_II,
+    POW: POW_II,
+    EQ: EQ_II,
+    NE: NE_II,
+    GT: GT_II,
+    LT: LT_II,
+    GE: GE_II,
+    LE: LE_II
+}
+
+STR_VARIANT = {
+    EQ: EQ_SS,
+    NE: NE_SS,
+    GT: GT_SS,
+    LT: LT_SS,
+    GE: GE_SS,
+    LE: LE_SS
+}
+
+INT_TYPED = {
+    ADD: ADD_INT,
+    SUB: SUB_INT,
+    MUL: MUL_INT,
+    DIV: DIV_INT,
+    MOD: MOD_INT,
+    POW: POW_INT,
+    EQ: EQ_INT,
+    NE: NE_INT,
+    GT: GT_INT,
+    LT: LT_INT,
+    GE: GE_INT,
+    LE: LE_INT,
+    NEG: NEG_INT
+}
+
+STR_TYPED = {
+    EQ: EQ_STR,
+    NE: NE_STR,
+    GT: GT_STR,
+    LT: LT_STR,
+    GE: GE_STR,
+    LE: LE_STR
+}
+
+TYPED_GENERIC = {}
+for plain, variant in INT_TYPED.items() + STR_TYPED.items():
+    TYPED_GENERIC[variant] = plain
+
+# comparisons fused with the J_IF_FALSE that follows them
+UNLESS_VARIANT = {
+    EQ: J_UNLESS_EQ,
+    NE: J_UNLESS_NE,
+    GT: J_UNLESS_GT,
+    LT: J_UNLESS_LT,
+    GE: J_UNLESS_GE,
+    LE: J_UNLESS_LE
+}
+
+UNLESS_COMPARE = {
+    J_UNLESS_EQ: EQ,
+    J_UNLESS_NE: NE,
+    J_UNLESS_GT: GT,
+    J_UNLESS_LT: LT,
+    J_UNLESS_GE: GE,
+    J_UNLESS_LE: LE
+}
+
+PACKED = {
+    INC_VAR: True,
+    LOAD_VARS: True,
+    FOR_LT: True,
+    FOR_INC: True
 }
 
 UNOP_CODE = {
@@ -69,6 +211,61 @@ UNOP_CODE = {
     "!": NOT
 }
 
+# net change in stack depth for opcodes whose effect does not depend
+# on their argument
+STACK_EFFECT = {
+    DROP_CONST: -1,
+    LOAD_CONST: 1,
+    LOAD_VAR: 1,
+    STORE_VAR: -1,
+    ADD: -1,
+    CONCAT: -1,
+    DIFF: -1,
+    SUB: -1,
+    MUL: -1,
+    DIV: -1,
+    MOD: -1,
+    POW: -1,
+    EQ: -1,
+    NE: -1,
+    GT: -1,
+    LT: -1,
+    GE: -1,
+    LE: -1,
+    NEG: 0,
+    NOT: 0,
+    RETURN: -1,
+    JUMP: 0,
+    J_IF_TRUE: -1,
+    J_IF_FALSE: -1,
+    ITERATE: 1,
+    GET_INDEX: -1,
+    SET_INDEX: -3,
+    LEN: 0,
+    CHARS: 1,
+    WORDS: 1,
+    LINES: 1,
+    GET_ITER: 0,
+    J_IF_FALSE_OR_POP: -1,
+    J_IF_TRUE_OR_POP: -1,
+    BOOL: 0,
+    INC_VAR: 0,
+    LOAD_VARS: 2,
+    INDEX_VAR: 0,
+    J_UNLESS_EQ: -2,
+    J_UNLESS_NE: -2,
+    J_UNLESS_GT: -2,
+    J_UNLESS_LT: -2,
+    J_UNLESS_GE: -2,
+    J_UNLESS_LE: -2,
+    FOR_LT: -1,
+    FOR_INC: 0
+}
+
+
+for plain, variant in INT_TYPED.items() + STR_TYPED.items():
+    STACK_EFFECT[variant] = STACK_EFFECT[plain]
+
 # names for dumping bc to terminal
 # spacing is odd because rpython disallows conventional string formatting
 NAMES = {
@@ -91,8 +288,6 @@ NAMES = {
     GT: "        GT",
     LE: "        LE",
     GE: "        GE",
-    AND: "       AND",
-    OR: "        OR",
     NEG: "       NEG",
     NOT: "       NOT",
     RETURN: "    RETURN",
@@ -106,17 +301,135 @@ NAMES = {
     LEN: "       LEN",
     CHARS: "     CHARS",
     WORDS: "     WORDS",
-    LINES: "     LINES"
+    LINES: "     LINES",
+    PACK_VARGS: "PACK_VARGS",
+    GET_ITER: "  GET_ITER",
+    ADD_II: "    ADD_II",
+    SUB_II: "    SUB_II",
+    MUL_II: "    MUL_II",
+    DIV_II: "    DIV_II",
+    MOD_II: "    MOD_II",
+    POW_II: "    POW_II",
+    EQ_II: "     EQ_II",
+    NE_II: "     NE_II",
+    GT_II: "     GT_II",
+    LT_II: "     LT_II",
+    GE_II: "     GE_II",
+    LE_II: "     LE_II",
+    EQ_SS: "     EQ_SS",
+    NE_SS: "     NE_SS",
+    GT_SS: "     GT_SS",
+    LT_SS: "     LT_SS",
+    GE_SS: "     GE_SS",
+    LE_SS: "     LE_SS",
+    J_IF_FALSE_OR_POP: " JF_OR_POP",
+    J_IF_TRUE_OR_POP: " JT_OR_POP",
+    BOOL: "      BOOL",
+    INC_VAR: "   INC_VAR",
+    LOAD_VARS: " LOAD_VARS",
+    INDEX_VAR: " INDEX_VAR",
+    J_UNLESS_EQ: "  J_UNL_EQ",
+    J_UNLESS_NE: "  J_UNL_NE",
+    J_UNLESS_GT: "  J_UNL_GT",
+    J_UNLESS_LT: "  J_UNL_LT",
+    J_UNLESS_GE: "  J_UNL_GE",
+    J_UNLESS_LE: "  J_UNL_LE",
+    FOR_LT: "    FOR_LT",
+    FOR_INC: "   FOR_INC",
+    ADD_INT: "   ADD_INT",
+    SUB_INT: "   SUB_INT",
+    MUL_INT: "   MUL_INT",
+    DIV_INT: "   DIV_INT",
+    MOD_INT: "   MOD_INT",
+    POW_INT: "   POW_INT",
+    EQ_INT: "    EQ_INT",
+    NE_INT: "    NE_INT",
+    GT_INT: "    GT_INT",
+    LT_INT: "    LT_INT",
+    GE_INT: "    GE_INT",
+    LE_INT: "    LE_INT",
+    EQ_STR: "    EQ_STR",
+    NE_STR: "    NE_STR",
+    GT_STR: "    GT_STR",
+    LT_STR: "    LT_STR",
+    GE_STR: "    GE_STR",
+    LE_STR: "    LE_STR",
+    NEG_INT: "   NEG_INT"
 }
 
 
+def pack(first, second):
+    return first | (second << PACK_SHIFT)
+
+
+def packable(first, second):
+    return 0 <= first <= PACK_MASK and 0 <= second <= PACK_MASK
+
+
+# the jump target of a jumping opcode's assembled argument
+def jumptarget(code, arg):
+    if code in PACKED:
+        return arg >> PACK_SHIFT
+    return arg
+
+
+def generic(code):
+    return TYPED_GENERIC.get(code, code)
+
+
+def endsblock(code):
+    return code == JUMP or code == FOR_INC or code == RETURN
+
+
+class Instruction(object):
+    def __init__(self, code, arg, target, package, line, col):
+        self.code = code
+        self.arg = arg
+        self.target = target
+        self.package = package
+        self.line = line
+        self.col = col
+
+
+# a basic block only ever jumps as its last instruction; jump targets
+# are blocks, and control falls through to the next block in layout
+class Block(object):
+    def __init__(self):
+        self.instructions = []
+        self.offset = 0
+        self.index = 0
+        self.targeted = False
+
+    def last(self):
+        if self.instructions == []:
+            return None
+        return self.instructions[-1]
+
+    def fallsthrough(self):
+        last = self.last()
+        if last is None:
+            return True
+        return not endsblock(last.code)
+
+
 class Compiler(object):
     def __init__(self):
         self.stack = []
         self.constants = []
         self.positions = []
         self.variables = {}
+        # where each function called is among the constants, and how
+        # many arguments each call passes until it is linked
         self.functions = {}
+        self.calls = {}
+        self.blocks = []
+        self.block = None
+        self.loops = []
+        self.numparams = 0
+        # a copy of the blocks for call sites to inline, kept once the
+        # optimizer has started on them
+        self.inlinebody = None
+        self.use_block(Block())
 
     def register_constant(self, value):
         self.constants.append(value)
@@ -130,98 +443,316 @@ class Compiler(object):
             self.variables[name + package] = len(self.variables)
             return len(self.variables) - 1
 
-    def register_function(self, function):
-        package = unicode(function.package)
+    def function_constant(self, function):
         try:
-            self.functions[function.name + package]
-            sodaError(function.package, function.line, function.col,
-                      "redeclaration of function \"%s\"" % function.name.encode
-                      ("utf-8"))
+            return self.functions[function]
         except KeyError:
-            self.functions[function.name +
-                           package] = self.register_constant(function)
+            self.functions[function] = self.register_constant(function)
+            return self.functions[function]
+
+    # a variable no source name can refer to, for code the optimizer
+    # moves into this compiler
+    def new_variable(self):
+        idx = len(self.variables)
+        self.variables[u"#" + unicode(str(idx))] = idx
+        return idx
+
+    def use_block(self, block):
+        self.blocks.append(block)
+        self.block = block
 
     def emit(self, code, arg=0, package="", line="-1", col="-1"):
-        self.stack.append(code)
-        self.stack.append(arg)
-        self.positions.append((package, line, col))
-        self.positions.append(("", "", ""))
+        self.block.instructions.append(Instruction(code, arg, None,
+                                                   package, line, col))
+
+    # a call to whichever function key names once the program is linked;
+    # until then its argument is that function's slot in the symbols
+    def emit_call(self, key, count, package, line, col):
+        instruction = Instruction(CALL, symbols.slot(key), None,
+                                  package, line, col)
+        self.block.instructions.append(instruction)
+        self.calls[instruction] = count
+
+    # resolves each call to the function in its slot, checking the
+    # number of arguments and packing the extra ones of variadic calls
+    def link(self):
+        for block in self.blocks:
+            result = []
+            for instruction in block.instructions:
+                if instruction.code == CALL and instruction in self.calls:
+                    count = self.calls[instruction]
+                    function = symbols.functions[instruction.arg]
+                    if function is None:
+                        instruction.arg = -1
+                    elif not function.isvariadic:
+                        if count == function.arity:
+                            instruction.arg = self.function_constant(function)
+                        else:
+                            instruction.arg = -2
+                    elif count < function.arity - 1:
+                        instruction.arg = -2
+                    else:
+                        result.append(Instruction(PACK_VARGS,
+                                                  count - function.arity + 1,
+                                                  None, instruction.package,
+                                                  instruction.line,
+                                                  instruction.col))
+                        instruction.arg = self.function_constant(function)
+                result.append(instruction)
+            block.instructions = result
+        self.calls = {}
+
+    # ends the current block with a jump to target and carries on
+    # emitting into a fresh block
+    def emit_jump(self, code, target, package="", line="-1", col="-1",
+                  arg=0):
+        self.block.instructions.append(Instruction(code, arg, target,
+                                                   package, line, col))
+        self.use_block(Block())
+
+    def emit_break(self, package, line, col):
+        if self.loops == []:
+            self.emit(JUMP, -3, package, line, col)
+        else:
+            self.emit_jump(JUMP, self.loops[-1], package, line, col)
+
+    def push_loop(self, breakblock):
+        self.loops.append(breakblock)
+
+    def pop_loop(self):
+        self.loops.pop()
+
+    # lays the blocks out in order and resolves jump targets to offsets
+    def assemble(self):
+        offset = 0
+        for block in self.blocks:
+            block.offset = offset
+            offset += 2 * len(block.instructions)
+        self.stack = []
+        self.positions = []
+        for block in self.blocks:
+            for instruction in block.instructions:
+                self.stack.append(instruction.code)
+                if instruction.target is not None and\
+                   instruction.code in PACKED:
+                    self.stack.append(pack(instruction.arg,
+                                           instruction.target.offset))
+                elif instruction.target is not None:
+                    self.stack.append(instruction.target.offset)
+                else:
+                    self.stack.append(instruction.arg)
+                self.positions.append((instruction.package,
+                                       instruction.line, instruction.col))
+                self.positions.append(("", "", ""))
+
+    def stack_effect(self, code, arg):
+        if code == STOR_ARRAY or code == PACK_VARGS:
+            return 1 - arg
+        elif code == CALL:
+            function = self.constants[arg]
+            assert isinstance(function, SodaFunction)
+            return 1 - function.arity
+        return STACK_EFFECT[code]
+
+    # walks every path through the code to find the deepest the value
+    # stack can get, so frames can preallocate it
+    def compute_stacksize(self):
+        depths = [-1] * (len(self.stack) // 2)
+        maxdepth = 0
+        pending = [0, 0]
+        while pending:
+            depth = pending.pop()
+            pc = pending.pop()
+            while pc < len(self.stack):
+                if depths[pc // 2] >= depth:
+                    break
+                depths[pc // 2] = depth
+                code = self.stack[pc]
+                arg = self.stack[pc + 1]
+                if code == RETURN:
+                    break
+                elif (code == JUMP or code == CALL) and arg < 0:
+                    break
+                depth += self.stack_effect(code, arg)
+                if depth > maxdepth:
+                    maxdepth = depth
+                if code == JUMP or code == FOR_INC:
+                    pc = jumptarget(code, arg)
+                    continue
+                elif code == J_IF_TRUE or code == J_IF_FALSE or\
+                        code in UNLESS_COMPARE or code == FOR_LT:
+                    pending.append(jumptarget(code, arg))
+                    pending.append(depth)
+                elif code == J_IF_FALSE_OR_POP or code == J_IF_TRUE_OR_POP:
+                    pending.append(arg)
+                    pending.append(depth + 1)
+                elif code == ITERATE:
+                    pending.append(arg)
+                    pending.append(depth - 2)
+                pc += 2
+        return maxdepth
 
     def create_bytecode(self):
-        return Bytecode(self.stack, self.positions, self.constants[:],
-                        len(self.variables))
+        # imported here since the optimizer's passes need this module
+        from soda.optimizer import optimizer
+        optimizer.run(self)
+        self.assemble()
+        return Bytecode(self.stack[:], self.positions[:], self.constants[:],
+                        len(self.variables), self.compute_stacksize())
 
 
 class Bytecode(object):
-    def __init__(self, code, positions, constants, numvars):
+    _immutable_fields_ = ["code[*]", "positions[*]", "constants[*]",
+                          "numvars", "stacksize"]
+
+    def __init__(self, code, positions, constants, numvars, stacksize):
         self.code = code
         self.positions = positions
         self.constants = constants
         self.numvars = numvars
+        self.stacksize = stacksize
         self.textarrays = []
+        self.quickened = code[:]
+        self.deopts = [False] * (len(code) // 2)
+
+    # rewrites a generic binary opcode into its int or string variant
+    # once it has seen what it operates on; mixed operands keep the
+    # generic opcode, and so does a site whose variant has ever failed
+    def quicken(self, pos, left, right):
+        if self.deopts[pos // 2]:
+            return
+        variant = -1
+        if isinstance(left, SodaInt) and isinstance(right, SodaInt):
+            variant = INT_VARIANT.get(self.code[pos], -1)
+        elif isinstance(left, SodaString) and isinstance(right, SodaString):
+            variant = STR_VARIANT.get(self.code[pos], -1)
+        if variant != -1:
+            self.quickened[pos] = variant
+
+    def dequicken(self, pos):
+        self.quickened[pos] = self.code[pos]
+        self.deopts[pos // 2] = True
 
     def dump(self):
         formatted = []
         for i in range(0, len(self.code), 2):
             opcode = NAMES[self.code[i]]
-            argument = str(self.code[i + 1])
+            arg = self.code[i + 1]
+            if self.code[i] in PACKED:
+                argument = "%d,%d" % (arg & PACK_MASK, arg >> PACK_SHIFT)
+            else:
+                argument = str(arg)
             formatted.append("%s %s\n" % (opcode, argument))
         return "".join(formatted)
 
+    # the optimized code of every function the program declares
+    def dumpfunctions(self):
+        formatted = []
+        for function in symbols.declared:
+            if function.bytecode is not None:
+                name = function.name.encode("utf-8")
+                formatted.append("\n%s.%s:\n" % (function.package, name))
+                formatted.append(function.bytecode.dump())
+        return "".join(formatted)
+
+    # text must be valid UTF-8; it is split on codepoint boundaries
+    # without being decoded, and each buffer holds one codepoint per item
     def create_arrays(self, text):
         self.textarrays = []
         chars, words, lines = [], [], []
         wordbuffer, linebuffer = [], []
         i, j, k = 0, 0, 0
-        a = rbigint()
-        text, trash = str_decode_utf_8(text, len(text), "strict", True)
-        for char in text:
+        pos = 0
+        while pos < len(text):
+            end = pos + charwidth(text[pos])
+            assert end >= pos
+            char = text[pos:end]
+            pos = end
             if char == " " and wordbuffer != []:
-                word = u"".join(wordbuffer)
-                words.append(SodaInt(a.fromint(j)))
-                words.append(SodaString(word))
+                words.append(newint(j))
+                words.append(SodaString("".join(wordbuffer),
+                                        len(wordbuffer)))
                 wordbuffer = []
                 j += 1
-                chars.append(SodaInt(a.fromint(i)))
-                chars.append(SodaString(char))
+                chars.append(newint(i))
+                chars.append(newchar(char))
                 linebuffer.append(char)
                 i += 1
             elif char == "\n" and linebuffer != []:
-                line = u"".join(linebuffer)
-                lines.append(SodaInt(a.fromint(k)))
-                lines.append(SodaString(line))
+                lines.append(newint(k))
+                lines.append(SodaString("".join(linebuffer),
+                                        len(linebuffer)))
                 linebuffer = []
                 k += 1
                 if not wordbuffer == []:
-                    word = u"".join(wordbuffer)
-                    words.append(SodaInt(a.fromint(j)))
-                    words.append(SodaString(word))
+                    words.append(newint(j))
+                    words.append(SodaString("".join(wordbuffer),
+                                            len(wordbuffer)))
                     wordbuffer = []
                     j += 1
-                chars.append(SodaInt(a.fromint(i)))
-                chars.append(SodaString(char))
+                chars.append(newint(i))
+                chars.append(newchar(char))
                 i += 1
             else:
-                chars.append(SodaInt(a.fromint(i)))
-                chars.append(SodaString(char))
+                chars.append(newint(i))
+                chars.append(newchar(char))
                 wordbuffer.append(char)
                 linebuffer.append(char)
                 i += 1
         if not wordbuffer == []:
-            word = u"".join(wordbuffer)
-            words.append(SodaInt(a.fromint(j)))
-            words.append(SodaString(word))
+            words.append(newint(j))
+            words.append(SodaString("".join(wordbuffer), len(wordbuffer)))
         if not linebuffer == []:
-            line = u"".join(linebuffer)
-            lines.append(SodaInt(a.fromint(k)))
-            lines.append(SodaString(line))
+            lines.append(newint(k))
+            lines.append(SodaString("".join(linebuffer), len(linebuffer)))
         self.textarrays.append(SodaArray(chars))
         self.textarrays.append(SodaArray(words))
         self.textarrays.append(SodaArray(lines))
 
 
+# every function the program declares, shared by all of its compilers;
+# a call names a slot, which the function's declaration fills in from
+# anywhere in the program, so calls can come before declarations
+class SymbolTable(object):
+    def __init__(self):
+        self.slots = {}
+        self.functions = []
+        self.declared = []
+
+    def slot(self, key):
+        try:
+            return self.slots[key]
+        except KeyError:
+            self.slots[key] = len(self.functions)
+            self.functions.append(None)
+            return len(self.functions) - 1
+
+    def declare(self, function):
+        idx = self.slot(function.name + unicode(function.package))
+        if self.functions[idx] is not None:
+            sodaError(function.package, function.line, function.col,
+                      "redeclaration of function \"%s\"" % function.name.encode
+                      ("utf-8"))
+        self.functions[idx] = function
+
+    # once the whole program is compiled, links and creates the bytecode
+    # of each function in the order their bodies were compiled in, then
+    # that of main
+    def link(self, main):
+        for function in self.declared:
+            compiler = function.compiler
+            assert compiler is not None
+            compiler.link()
+            function.bytecode = compiler.create_bytecode()
+        main.link()
+        return main.create_bytecode()
+
+
+symbols = SymbolTable()
+
+
 def compile_ast(ast_node):
     compiler = Compiler()
     for node in ast_node.get():
         node.compile(compiler)
-    return compiler.create_bytecode()
+    return symbols.link(compiler)
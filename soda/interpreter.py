@@ -5,39 +5,283 @@
 # program stack
 
 from soda import bytecode
-from soda.objects import SodaArray
+from soda.objects import SodaArray, SodaFunction, SodaIterator
+from soda.objects import SodaInt, SodaSmallInt, SodaString
+from soda.objects import newbool, newint
+from soda.objects import TRUE, FALSE
 from soda.errors import sodaError
 from rpython.rlib import jit
+from rpython.rlib.rarithmetic import ovfcheck
 import os
 
-driver = jit.JitDriver(greens=["pc", "iteridx", "code",
-                               "positions", "bc"],
-                       reds=["frame"],
+# default limit on the number of nested soda function calls;
+# frames live on the heap, so this only guards against runaway recursion
+MAXDEPTH = 100000
+
+# number of calls compiled code may nest on the host stack before they
+# are unwound onto the heap frame stack
+MAXNESTING = 200
+
+
+def get_printable_location(pc, code, positions, bc):
+    package, line, col = positions[pc]
+    return "%s.na:%s:%s %s" % (package, line, col,
+                               bytecode.NAMES[code[pc]])
+
+
+driver = jit.JitDriver(greens=["pc", "code", "positions", "bc"],
+                       reds=["maxdepth", "frame"],
+                       virtualizables=["frame"],
+                       get_printable_location=get_printable_location,
                        is_recursive=True)
 
+INT_ERRORS = {
+    bytecode.ADD: "cannot add non-integer types",
+    bytecode.SUB: "cannot subtract non-integer types",
+    bytecode.MUL: "cannot multiply non-integer types",
+    bytecode.DIV: "cannot divide non-integer types",
+    bytecode.MOD: "cannot modulo non-integer types",
+    bytecode.POW: "cannot exponentiate non-integer types",
+    bytecode.NEG: "cannot negate non-integer type"
+}
+
+STR_ERRORS = {
+    bytecode.CONCAT: "cannot concatenate non-string types",
+    bytecode.DIFF: "cannot find string difference of non-string types"
+}
+
+
+# io.Print and io.Error write their argument out directly; the callee is
+# a constant in traces, so this folds away
+@jit.elidable
+def outputstream(function):
+    if unicode(function.package) == u"io":
+        if unicode(function.name) == u"Print":
+            return 1
+        elif unicode(function.name) == u"Error":
+            return 2
+    return 0
+
+
+# the generic opcode behind a typed variant or fused compare-and-branch;
+# the opcode is green, so this folds away in traces
+@jit.elidable
+def plain(code):
+    if code in bytecode.UNLESS_COMPARE:
+        return bytecode.UNLESS_COMPARE[code]
+    return bytecode.generic(code)
+
+
+# converts an operand of the integer opcode code, reporting that
+# opcode's error if it cannot be
+def toint(value, code, package, line, col):
+    if not value.isint():
+        try:
+            value = value.toint()
+        except Exception:
+            sodaError(package, line, col, INT_ERRORS[code])
+    return value
+
+
+def tostr(value, code, package, line, col):
+    if not value.isstr():
+        try:
+            value = value.tostr()
+        except Exception:
+            sodaError(package, line, col, STR_ERRORS[code])
+    return value
+
+
+def comparison(code, right, left):
+    if code == bytecode.EQ:
+        return right.eq(left)
+    elif code == bytecode.NE:
+        return right.ne(left)
+    elif code == bytecode.GT:
+        return right.gt(left)
+    elif code == bytecode.LT:
+        return right.lt(left)
+    elif code == bytecode.GE:
+        return right.ge(left)
+    return right.le(left)
+
+
+# a binary opcode on operands that already have the type it needs
+def binary(code, right, left, package, line, col):
+    if code == bytecode.ADD:
+        return right.add(left)
+    elif code == bytecode.SUB:
+        return right.sub(left)
+    elif code == bytecode.MUL:
+        return right.mul(left)
+    elif code == bytecode.DIV:
+        try:
+            return right.div(left)
+        except ZeroDivisionError:
+            sodaError(package, line, col,
+                      "cannot divide by zero")
+    elif code == bytecode.MOD:
+        try:
+            return right.mod(left)
+        except ZeroDivisionError:
+            sodaError(package, line, col,
+                      "cannot modulo by zero")
+    elif code == bytecode.POW:
+        try:
+            return right.pow(left)
+        except ValueError:
+            sodaError(package, line, col,
+                      "cannot exponentiate by a negative integer")
+    else:
+        return comparison(code, right, left)
+    return None
+
+
+# the test a comparison makes, converting mixed operands first
+def compare(code, right, left, package, line, col):
+    if left.isstr() and right.isstr() or left.isint()\
+       and right.isint():
+        return comparison(code, right, left).istrue()
+    try:
+        right = right.toint()
+        left = left.toint()
+        return comparison(code, right, left).istrue()
+    except Exception:
+        try:
+            right = right.tostr()
+            left = left.tostr()
+            return comparison(code, right, left).istrue()
+        except Exception:
+            sodaError(package, line, col,
+                      "cannot compare arrays")
+    return False
+
+
+def truth(operand, package, line, col):
+    if operand.isarray():
+        sodaError(package, line, col,
+                  "cannot compare arrays")
+    return operand.istrue()
+
+
+def getindex(var, expr, package, line, col):
+    try:
+        return var.getval(expr)
+    except IndexError:
+        sodaError(package, line, col,
+                  "string index out of range")
+    except Exception:
+        sodaError(package, line, col,
+                  "cannot index integers")
+    return None
+
+
+def callerror(arg, package, line, col):
+    if arg == -1:
+        sodaError(package, line, col,
+                  "cannot evaluate undeclared function")
+    elif arg == -2:
+        sodaError(package, line, col,
+                  "number of arguments passed to function "
+                  "must match number of expected parameters")
+    sodaError(package, line, col,
+              "maximum recursion depth exceeded")
+
+
+# runs the quickened opcode at pos and returns the pc to carry on from;
+# operands that no longer match the type it was quickened for send the
+# site back to its generic opcode for good
+def quickened(frame, bc, c, pos, package, line, col):
+    right = frame.pop()
+    left = frame.pop()
+    if c <= bytecode.LE_II:
+        matches = isinstance(right, SodaInt) and isinstance(left, SodaInt)
+    else:
+        matches = isinstance(right, SodaString) and\
+            isinstance(left, SodaString)
+    if not matches:
+        bc.dequicken(pos)
+        frame.push(left)
+        frame.push(right)
+        return pos
+    frame.push(binary(bc.code[pos], right, left, package, line, col))
+    return pos + 2
+
 
 class Frame(object):
-    def __init__(self, bc):
-        self.valuestack = []
+    _virtualizable_ = ["valuestack[*]", "valuestack_pos", "variables[*]"]
+    _immutable_fields_ = ["bc", "textarrays", "parent", "depth"]
+
+    # the caller hands over the arguments, so only the frame being set
+    # up writes its own variables
+    @jit.unroll_safe
+    def __init__(self, bc, textarrays, parent, args):
+        self = jit.hint(self, access_directly=True, fresh_virtualizable=True)
+        self.valuestack = [None] * bc.stacksize
         self.variables = [None] * bc.numvars
+        for i in range(len(args)):
+            self.variables[i] = args[i]
         self.valuestack_pos = 0
+        self.textarrays = textarrays
+        self.bc = bc
+        self.parent = parent
+        if parent is None:
+            self.depth = 0
+        else:
+            self.depth = parent.depth + 1
+        self.pc = 0
+        self.isportal = False
+        self.retval = None
 
     def push(self, value):
-        self.valuestack.append(value)
+        pos = self.valuestack_pos
+        assert pos >= 0
+        self.valuestack[pos] = value
+        self.valuestack_pos = pos + 1
+
+    def peek(self):
+        pos = self.valuestack_pos - 1
+        assert pos >= 0
+        return self.valuestack[pos]
 
     def pop(self):
-        return self.valuestack.pop()
+        pos = self.valuestack_pos - 1
+        assert pos >= 0
+        value = self.valuestack[pos]
+        self.valuestack[pos] = None
+        self.valuestack_pos = pos
+        return value
+
 
+# counts the execute() calls compiled code has nested on the host stack
+class Nesting(object):
+    def __init__(self):
+        self.depth = 0
 
-def run(frame, bc):
+
+nesting = Nesting()
+
+
+# carries the frame that was about to run out to interpret(), which
+# resumes it and then its callers from the heap
+class Unwind(Exception):
+    def __init__(self, frame):
+        self.frame = frame
+
+
+def run(frame, maxdepth):
+    bc = frame.bc
     code = bc.code
     positions = bc.positions
-    pc = 0
-    iteridx = 0
-    while pc < len(bc.code):
-        driver.jit_merge_point(pc=pc, iteridx=iteridx, code=code,
-                               positions=positions, bc=bc, frame=frame)
-        c = code[pc]
+    pc = frame.pc
+    while pc < len(code):
+        driver.jit_merge_point(pc=pc, code=code,
+                               positions=positions, bc=bc,
+                               maxdepth=maxdepth, frame=frame)
+        if jit.we_are_jitted():
+            c = code[pc]
+        else:
+            c = bc.quickened[pc]
         arg = code[pc + 1]
         package, line, col = positions[pc]
         pc += 2
@@ -50,6 +294,7 @@ def run(frame, bc):
             if arg == -1:
                 sodaError(package, line, col,
                           "cannot evaluate undeclared variable")
+            assert arg >= 0
             var = frame.variables[arg]
             frame.push(var)
         elif c == bytecode.STORE_VAR:
@@ -57,7 +302,69 @@ def run(frame, bc):
             line = line
             col = col
             value = frame.pop()
+            assert arg >= 0
             frame.variables[arg] = value
+        elif c == bytecode.FOR_LT:
+            counter = frame.variables[arg & bytecode.PACK_MASK]
+            bound = frame.pop()
+            if isinstance(counter, SodaSmallInt) and\
+               isinstance(bound, SodaSmallInt):
+                if not counter.intval < bound.intval:
+                    pc = arg >> bytecode.PACK_SHIFT
+            elif not compare(bytecode.LT, counter, bound, package, line,
+                             col):
+                pc = arg >> bytecode.PACK_SHIFT
+        elif c == bytecode.FOR_INC:
+            idx = arg & bytecode.PACK_MASK
+            counter = frame.variables[idx]
+            if isinstance(counter, SodaSmallInt):
+                try:
+                    counter = SodaSmallInt(ovfcheck(counter.intval + 1))
+                except OverflowError:
+                    counter = counter.add(newint(1))
+            else:
+                counter = toint(counter, bytecode.ADD, package, line, col)
+                counter = counter.add(newint(1))
+            frame.variables[idx] = counter
+            pc = arg >> bytecode.PACK_SHIFT
+            driver.can_enter_jit(pc=pc, code=code,
+                                 positions=positions, bc=bc,
+                                 maxdepth=maxdepth, frame=frame)
+        elif c == bytecode.INC_VAR:
+            idx = arg & bytecode.PACK_MASK
+            const = arg >> bytecode.PACK_SHIFT
+            assert const >= 0
+            right = toint(frame.variables[idx], bytecode.ADD, package, line,
+                          col)
+            left = toint(bc.constants[const], bytecode.ADD, package, line,
+                         col)
+            frame.variables[idx] = right.add(left)
+        elif c == bytecode.LOAD_VARS:
+            first = arg & bytecode.PACK_MASK
+            second = arg >> bytecode.PACK_SHIFT
+            assert second >= 0
+            frame.push(frame.variables[first])
+            frame.push(frame.variables[second])
+        elif c == bytecode.INDEX_VAR:
+            assert arg >= 0
+            expr = frame.variables[arg]
+            var = frame.pop()
+            frame.push(getindex(var, expr, package, line, col))
+        elif c >= bytecode.J_UNLESS_EQ and c <= bytecode.J_UNLESS_LE:
+            right = frame.pop()
+            left = frame.pop()
+            if not compare(plain(c), right, left, package, line, col):
+                pc = arg
+        elif c >= bytecode.ADD_II and c <= bytecode.LE_SS:
+            pc = quickened(frame, bc, c, pc - 2, package, line, col)
+        elif c >= bytecode.ADD_INT and c <= bytecode.LE_STR:
+            right = frame.pop()
+            left = frame.pop()
+            frame.push(binary(plain(c), right, left, package, line, col))
+        elif c == bytecode.NEG_INT:
+            operand = frame.pop()
+            assert isinstance(operand, SodaInt)
+            frame.push(operand.neg())
         elif c == bytecode.STOR_ARRAY:
             package = package
             line = line
@@ -68,416 +375,108 @@ def run(frame, bc):
             sa = SodaArray(items)
             frame.push(sa)
         elif c == bytecode.NEG:
-            operand = frame.pop()
-            if not operand.isint():
-                try:
-                    operand = operand.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot negate non-integer type")
-            result = operand.neg()
-            frame.push(result)
-        elif c == bytecode.ADD:
+            operand = toint(frame.pop(), c, package, line, col)
+            frame.push(operand.neg())
+        elif c == bytecode.ADD or c >= bytecode.SUB and c <= bytecode.POW:
             right = frame.pop()
             left = frame.pop()
-            if not right.isint():
-                try:
-                    right = right.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot add non-integer types")
-            if not left.isint():
-                try:
-                    left = left.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot add non-integer types")
-            result = right.add(left)
-            frame.push(result)
+            if not jit.we_are_jitted():
+                bc.quicken(pc - 2, left, right)
+            right = toint(right, c, package, line, col)
+            left = toint(left, c, package, line, col)
+            frame.push(binary(c, right, left, package, line, col))
         elif c == bytecode.CONCAT:
             right = frame.pop()
-            left = frame.pop()
-            if not left.isstr():
-                try:
-                    left = left.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot concatenate non-string types")
-            if not right.isstr():
-                try:
-                    right = right.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot concatenate non-string types")
-            result = right.concat(left)
-            frame.push(result)
+            left = tostr(frame.pop(), c, package, line, col)
+            right = tostr(right, c, package, line, col)
+            frame.push(right.concat(left))
         elif c == bytecode.DIFF:
             right = frame.pop()
-            left = frame.pop()
-            if not left.isstr():
-                try:
-                    left = left.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot find string difference of non-string"
-                              " types")
-            if not right.isstr():
-                try:
-                    right = right.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot find string difference of non-string"
-                              " types")
-            result = right.diff(left)
-            frame.push(result)
-        elif c == bytecode.SUB:
-            right = frame.pop()
-            left = frame.pop()
-            if not right.isint():
-                try:
-                    right = right.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot subtract non-integer types")
-            if not left.isint():
-                try:
-                    left = left.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot subtract non-integer types")
-            result = right.sub(left)
-            frame.push(result)
-        elif c == bytecode.MUL:
-            right = frame.pop()
-            left = frame.pop()
-            if not right.isint():
-                try:
-                    right = right.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot multiply non-integer types")
-            if not left.isint():
-                try:
-                    left = left.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot multiply non-integer types")
-            result = right.mul(left)
-            frame.push(result)
-        elif c == bytecode.DIV:
+            left = tostr(frame.pop(), c, package, line, col)
+            right = tostr(right, c, package, line, col)
+            frame.push(right.diff(left))
+        elif c >= bytecode.EQ and c <= bytecode.LE:
             right = frame.pop()
             left = frame.pop()
-            if not right.isint():
-                try:
-                    right = right.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot divide non-integer types")
-            if not left.isint():
-                try:
-                    left = left.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot divide non-integer types")
-            try:
-                result = right.div(left)
-            except ZeroDivisionError:
-                sodaError(package, line, col,
-                          "cannot divide by zero")
-                break
-            frame.push(result)
-        elif c == bytecode.MOD:
-            right = frame.pop()
-            left = frame.pop()
-            if not right.isint():
-                try:
-                    right = right.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot modulo non-integer types")
-            if not left.isint():
-                try:
-                    left = left.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot modulo non-integer types")
-            try:
-                result = right.mod(left)
-            except ZeroDivisionError:
-                sodaError(package, line, col,
-                          "cannot modulo by zero")
-                break
-            frame.push(result)
-        elif c == bytecode.POW:
-            right = frame.pop()
-            left = frame.pop()
-            if not right.isint():
-                try:
-                    right = right.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot exponentiate non-integer types")
-            if not left.isint():
-                try:
-                    left = left.toint()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot exponentiate non-integer types")
-            try:
-                result = right.pow(left)
-            except ValueError:
-                sodaError(package, line, col,
-                          "cannot exponentiate by a negative integer")
-                break
-            frame.push(result)
-        elif c == bytecode.EQ:
-            right = frame.pop()
-            left = frame.pop()
-            if left.isstr() and right.isstr() or left.isint()\
-               and right.isint():
-                result = right.eq(left)
-                frame.push(result)
-                continue
-            try:
-                right = right.toint()
-                left = left.toint()
-                result = right.eq(left)
-                frame.push(result)
-                continue
-            except Exception:
-                try:
-                    right = right.tostr()
-                    left = left.tostr()
-                    result = right.eq(left)
-                    frame.push(result)
-                    continue
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-        elif c == bytecode.NE:
-            right = frame.pop()
-            left = frame.pop()
-            if left.isstr() and right.isstr() or left.isint()\
-               and right.isint():
-                result = right.ne(left)
-                frame.push(result)
-                continue
-            try:
-                right = right.toint()
-                left = left.toint()
-                result = right.ne(left)
-                frame.push(result)
-                continue
-            except Exception:
-                try:
-                    right = right.tostr()
-                    left = left.tostr()
-                    result = right.ne(left)
-                    frame.push(result)
-                    continue
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-        elif c == bytecode.GT:
-            right = frame.pop()
-            left = frame.pop()
-            if left.isstr() and right.isstr() or left.isint()\
-               and right.isint():
-                result = right.gt(left)
-                frame.push(result)
-                continue
-            try:
-                right = right.toint()
-                left = left.toint()
-                result = right.gt(left)
-                frame.push(result)
-                continue
-            except Exception:
-                try:
-                    right = right.tostr()
-                    left = left.tostr()
-                    result = right.gt(left)
-                    frame.push(result)
-                    continue
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-        elif c == bytecode.LT:
-            right = frame.pop()
-            left = frame.pop()
-            if left.isstr() and right.isstr() or left.isint()\
-               and right.isint():
-                result = right.lt(left)
-                frame.push(result)
-                continue
-            try:
-                right = right.toint()
-                left = left.toint()
-                result = right.lt(left)
-                frame.push(result)
-                continue
-            except Exception:
-                try:
-                    right = right.tostr()
-                    left = left.tostr()
-                    result = right.lt(left)
-                    frame.push(result)
-                    continue
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-        elif c == bytecode.GE:
-            right = frame.pop()
-            left = frame.pop()
-            if left.isstr() and right.isstr() or left.isint()\
-               and right.isint():
-                result = right.ge(left)
-                frame.push(result)
-                continue
-            try:
-                right = right.toint()
-                left = left.toint()
-                result = right.ge(left)
-                frame.push(result)
-                continue
-            except Exception:
-                try:
-                    right = right.tostr()
-                    left = left.tostr()
-                    result = right.ge(left)
-                    frame.push(result)
-                    continue
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-        elif c == bytecode.LE:
-            right = frame.pop()
-            left = frame.pop()
-            if left.isstr() and right.isstr() or left.isint()\
-               and right.isint():
-                result = right.le(left)
-                frame.push(result)
-                continue
-            try:
-                right = right.toint()
-                left = left.toint()
-                result = right.le(left)
-                frame.push(result)
-                continue
-            except Exception:
-                try:
-                    right = right.tostr()
-                    left = left.tostr()
-                    result = right.le(left)
-                    frame.push(result)
-                    continue
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-        elif c == bytecode.AND:
-            right = frame.pop()
-            left = frame.pop()
-            if not left.isstr():
-                try:
-                    left = left.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-            if not right.isstr():
-                try:
-                    right = right.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-            result = right.land(left)
-            frame.push(result)
-        elif c == bytecode.OR:
-            right = frame.pop()
-            left = frame.pop()
-            if not left.isstr():
-                try:
-                    left = left.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-            if not right.isstr():
-                try:
-                    right = right.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-            result = right.lor(left)
-            frame.push(result)
+            if not jit.we_are_jitted():
+                bc.quicken(pc - 2, left, right)
+            frame.push(newbool(compare(c, right, left, package, line, col)))
         elif c == bytecode.NOT:
-            operand = frame.pop()
-            if not operand.isstr():
-                try:
-                    operand = operand.tostr()
-                except Exception:
-                    sodaError(package, line, col,
-                              "cannot compare arrays")
-            result = operand.lnot()
-            frame.push(result)
+            frame.push(newbool(not truth(frame.pop(), package, line, col)))
         elif c == bytecode.RETURN:
             result = frame.pop()
-            return result
+            if jit.we_are_jitted() or frame.isportal:
+                frame.retval = result
+                return frame
+            parent = frame.parent
+            assert parent is not None
+            frame = jit.hint(parent, access_directly=True)
+            bc = frame.bc
+            code = bc.code
+            positions = bc.positions
+            pc = frame.pc
+            frame.push(result)
         elif c == bytecode.CALL:
-            if arg == -1:
-                sodaError(package, line, col,
-                          "cannot evaluate undeclared function")
-            elif arg == -2:
-                sodaError(package, line, col,
-                          "number of arguments passed to function "
-                          "must match number of expected parameters")
+            if arg < 0 or frame.depth >= maxdepth:
+                callerror(arg, package, line, col)
             function = bc.constants[arg]
-            if unicode(function.name) == u"Print" and unicode(
-                    function.package) == u"io":
-                output = frame.pop().str()
-                os.write(1, output)
-                fbc = function.compiler.create_bytecode()
-                frame.push(interpret(fbc))
-            if unicode(function.name) == u"Error" and unicode(
-                    function.package) == u"io":
-                output = frame.pop().str()
-                os.write(2, output)
-                fbc = function.compiler.create_bytecode()
-                frame.push(interpret(fbc))
-            else:
-                arglist = []
-                if function.isvariadic:
-                    function.numargs = len(frame.valuestack)
-                for i in range(0, function.numargs):
-                    value = frame.pop()
-                    arglist.append(value)
-                function.evaluate_args(arglist)
-                fbc = function.compiler.create_bytecode()
-                fbc.textarrays = bc.textarrays
-                try:
-                    function.revert_state()
-                    result = interpret(fbc)
-                    frame.push(result)
-                except RuntimeError:
-                    sodaError(package, line, col,
-                              "maximum recursion depth exceeded")
+            assert isinstance(function, SodaFunction)
+            args = [None] * function.arity
+            i = function.arity - 1
+            while i >= 0:
+                args[i] = frame.pop()
+                i -= 1
+            stream = outputstream(function)
+            if stream != 0:
+                os.write(stream, args[0].str())
+            newframe = Frame(function.bytecode, frame.textarrays, frame,
+                             args)
+            frame.pc = pc
+            if jit.we_are_jitted():
+                newframe.isportal = True
+                frame.push(execute(newframe, maxdepth))
+                continue
+            frame = jit.hint(newframe, access_directly=True)
+            bc = frame.bc
+            code = bc.code
+            positions = bc.positions
+            pc = 0
+            # function entry is a JIT entry point as well; calls from
+            # compiled code reach the same entry through execute()
+            driver.can_enter_jit(pc=pc, code=code,
+                                 positions=positions, bc=bc,
+                                 maxdepth=maxdepth, frame=frame)
         elif c == bytecode.J_IF_TRUE:
-            if not frame.pop().str() == "false":
+            if frame.pop().istrue():
                 pc = arg
         elif c == bytecode.J_IF_FALSE:
-            if frame.pop().str() == "false":
+            if not frame.pop().istrue():
                 pc = arg
-        elif c == bytecode.ITERATE:
+        elif c == bytecode.GET_ITER:
             array = frame.pop()
-            try:
-                keyval = array.getkey(iteridx)
-                if keyval is None:
-                    pc = arg
-                    iteridx = 0
-                else:
-                    frame.push(keyval)
-                    iteridx += 1
-            except Exception:
+            if not array.isarray():
                 sodaError(package, line, col,
                           "cannot iterate non-array types")
+            frame.push(SodaIterator(array))
+        elif c == bytecode.J_IF_FALSE_OR_POP:
+            if not truth(frame.pop(), package, line, col):
+                frame.push(FALSE)
+                pc = arg
+        elif c == bytecode.J_IF_TRUE_OR_POP:
+            if truth(frame.pop(), package, line, col):
+                frame.push(TRUE)
+                pc = arg
+        elif c == bytecode.BOOL:
+            frame.push(newbool(truth(frame.pop(), package, line, col)))
+        elif c == bytecode.ITERATE:
+            iterator = frame.peek()
+            assert isinstance(iterator, SodaIterator)
+            keyval = iterator.next()
+            if keyval is None:
+                frame.pop()
+                pc = arg
+            else:
+                frame.push(keyval)
         elif c == bytecode.SET_INDEX:
             expr = frame.pop()
             var = frame.pop()
@@ -490,15 +489,7 @@ def run(frame, bc):
         elif c == bytecode.GET_INDEX:
             expr = frame.pop()
             var = frame.pop()
-            try:
-                result = var.getval(expr)
-                frame.push(result)
-            except IndexError:
-                sodaError(package, line, col,
-                          "string index out of range")
-            except Exception:
-                sodaError(package, line, col,
-                          "cannot index integers")
+            frame.push(getindex(var, expr, package, line, col))
         elif c == bytecode.JUMP:
             if arg == -3:
                 sodaError(package, line, col,
@@ -506,26 +497,68 @@ def run(frame, bc):
             oldpc = pc
             pc = arg
             if pc < oldpc:
-                driver.can_enter_jit(pc=pc, iteridx=iteridx, code=code,
-                                     positions=positions, bc=bc, frame=frame)
+                driver.can_enter_jit(pc=pc, code=code,
+                                     positions=positions, bc=bc,
+                                     maxdepth=maxdepth, frame=frame)
+        elif c == bytecode.PACK_VARGS:
+            items = [None] * (2 * arg)
+            i = arg - 1
+            while i >= 0:
+                items[2 * i] = newint(i)
+                items[2 * i + 1] = frame.pop()
+                i -= 1
+            frame.push(SodaArray(items))
         elif c == bytecode.LEN:
-            length = frame.pop().length
+            length = frame.pop().getlength()
             if length is not None:
                 frame.push(length)
             else:
                 sodaError(package, line, col,
                           "cannot find length of integer")
         elif c == bytecode.CHARS:
-            frame.push(bc.textarrays[0])
+            frame.push(frame.textarrays[0])
         elif c == bytecode.WORDS:
-            frame.push(bc.textarrays[1])
+            frame.push(frame.textarrays[1])
         elif c == bytecode.LINES:
-            frame.push(bc.textarrays[2])
+            frame.push(frame.textarrays[2])
         else:
             sodaError("test", "-1", "-1", "unrecognized bytecode %s" % c)
+    return frame
+
+
+# runs current and then its callers until frame returns; a frame
+# entered by the plain interpreter is switched to in place, so when one
+# of them returns from inside compiled code, its caller is resumed here.
+# traces see through this loop, so calls between compiled functions go
+# straight to call_assembler
+@jit.unroll_safe
+def resume(current, frame, maxdepth):
+    while True:
+        done = run(current, maxdepth)
+        if done is frame:
+            return done.retval
+        current = done.parent
+        current.push(done.retval)
+
+
+# runs a call made from compiled code; past MAXNESTING of these on the
+# host stack, the whole chain is handed back to interpret() instead
+def execute(frame, maxdepth):
+    if nesting.depth >= MAXNESTING:
+        raise Unwind(frame)
+    nesting.depth += 1
+    try:
+        return resume(frame, frame, maxdepth)
+    finally:
+        nesting.depth -= 1
 
 
-def interpret(bc):
-    frame = Frame(bc)
-    result = run(frame, bc)
-    return result
+def interpret(bc, maxdepth=MAXDEPTH):
+    frame = Frame(bc, bc.textarrays, None, [])
+    frame.isportal = True
+    current = frame
+    while True:
+        try:
+            return resume(current, frame, maxdepth)
+        except Unwind as unwind:
+            current = unwind.frame
@@ -4,26 +4,89 @@
 # objects.py defines the primitive datatypes of soda
 
 from rply.token import BaseBox
-from rpython.rlib.rstring import replace, UnicodeBuilder
+from rpython.rlib.rstring import replace, StringBuilder
 from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rarithmetic import ovfcheck
 
 
 class SodaObject(BaseBox):
     pass
 
 
-class SodaDummy(SodaObject):
-    def __init__(self):
-        pass
+# how many bytes the UTF-8 sequence starting with byte takes
+def charwidth(byte):
+    code = ord(byte)
+    if code < 0x80:
+        return 1
+    elif code < 0xe0:
+        return 2
+    elif code < 0xf0:
+        return 3
+    return 4
+
+
+def continues(string, i, low, high):
+    return i < len(string) and low <= ord(string[i]) <= high
+
+
+# the number of codepoints in string, or -1 when it is not valid UTF-8
+def utf8length(string):
+    size = 0
+    i = 0
+    while i < len(string):
+        code = ord(string[i])
+        if code < 0x80:
+            width = 1
+        elif 0xc2 <= code <= 0xdf:
+            width = 2
+        elif 0xe0 <= code <= 0xef:
+            low, high = 0x80, 0xbf
+            if code == 0xe0:
+                low = 0xa0
+            elif code == 0xed:
+                high = 0x9f
+            if not continues(string, i + 1, low, high):
+                return -1
+            width = 3
+        elif 0xf0 <= code <= 0xf4:
+            low, high = 0x80, 0xbf
+            if code == 0xf0:
+                low = 0x90
+            elif code == 0xf4:
+                high = 0x8f
+            if not continues(string, i + 1, low, high):
+                return -1
+            width = 4
+        else:
+            return -1
+        for j in range(i + 1, i + width):
+            if not continues(string, j, 0x80, 0xbf):
+                return -1
+        i += width
+        size += 1
+    return size
+
 
+# codepoints between the byte offsets kept by a string's index
+INDEX_STEP = 64
 
+
+# the result of ++; values concatenated onto one another share a builder,
+# each reading it only up to the length it had when the value was made
 class SodaBuilder(SodaObject):
-    def __init__(self, value):
+    def __init__(self, value, length):
         self.value = value
+        self.length = length
 
+    # appends in place while this value still owns the end of the builder,
+    # and copies once something else has appended past it
     def concat(self, other):
-        self.value.append(unicode(other.str()))
-        return SodaBuilder(self.value)
+        builder = self.value
+        if builder.getlength() != self.length:
+            builder = StringBuilder()
+            builder.append(self.str())
+        builder.append(other.str())
+        return SodaBuilder(builder, builder.getlength())
 
     def diff(self, other):
         return (self.tostr().diff(other.tostr()))
@@ -31,15 +94,14 @@ class SodaBuilder(SodaObject):
     def getkey(self, keypos):
         raise Exception
 
+    def getlength(self):
+        return self.tostr().getlength()
+
     def setval(self, idx, value):
         raise Exception
 
     def getval(self, idx):
-        string = self.value.build()
-        if idx.toint().integer() > len(string) - 1:
-            raise IndexError
-        val = string[idx.toint().integer()]
-        return SodaString(val)
+        return self.tostr().getval(idx)
 
     def eq(self, other):
         return (self.tostr().eq(other.tostr()))
@@ -68,6 +130,9 @@ class SodaBuilder(SodaObject):
     def lnot(self):
         return (self.tostr().lnot())
 
+    def istrue(self):
+        return not self.str() == "false"
+
     def isstr(self):
         return True
 
@@ -79,106 +144,132 @@ class SodaBuilder(SodaObject):
 
     def toint(self):
         a = rbigint()
-        number = a.fromstr(str(self.value.build()))
-        return SodaInt(number)
+        number = a.fromstr(self.str())
+        return newbigint(number)
 
+    # everything appended came from str(), so it is valid UTF-8
     def tostr(self):
-        return SodaString(self.value.build())
+        string = self.str()
+        return SodaString(string, utf8length(string))
 
     def str(self):
-        return self.value.build().encode("utf-8")
-
-
+        string = self.value.build()
+        length = self.length
+        if len(string) != length:
+            assert length >= 0
+            string = string[:length]
+        return string
+
+
+# text is kept as UTF-8, so printing it or hashing it never converts it,
+# along with how many codepoints it has. strings that are all ASCII are
+# indexed by byte; the others build an index of the byte offset of every
+# INDEX_STEP-th codepoint the first time they are indexed, so finding
+# any one takes fewer than INDEX_STEP steps from the nearest
 class SodaString(SodaObject):
-    def __init__(self, value):
-        assert isinstance(value, unicode)
+    _immutable_fields_ = ["value", "size"]
+
+    def __init__(self, value, size):
+        assert isinstance(value, str)
         self.value = value
-        a = rbigint()
-        self.length = SodaInt(a.fromint(len(self.value)))
+        self.size = size
+        self.offsets = None
 
     def concat(self, other):
-        builder = UnicodeBuilder()
+        builder = StringBuilder()
         builder.append(self.value)
-        builder.append(unicode(other.str()))
-        return SodaBuilder(builder)
+        builder.append(other.str())
+        return SodaBuilder(builder, builder.getlength())
 
     def diff(self, other):
         assert isinstance(other, SodaString)
-        return SodaString(replace(self.value, other.value, u""))
+        # a valid needle can only match on codepoint boundaries
+        string = replace(self.value, other.value, "")
+        return SodaString(string, utf8length(string))
 
     def getkey(self, keypos):
         raise Exception
 
+    def getlength(self):
+        return newint(self.size)
+
+    def isascii(self):
+        return self.size == len(self.value)
+
+    # the byte offset of the codepoint at pos
+    def offset(self, pos):
+        if self.offsets is None:
+            offsets = []
+            i = 0
+            count = 0
+            while i < len(self.value):
+                if count % INDEX_STEP == 0:
+                    offsets.append(i)
+                i += charwidth(self.value[i])
+                count += 1
+            self.offsets = offsets
+        i = self.offsets[pos // INDEX_STEP]
+        for step in range(pos % INDEX_STEP):
+            i += charwidth(self.value[i])
+        return i
+
     def getval(self, idx):
-        if idx.toint().integer() > len(self.value) - 1:
+        pos = idx.toint().integer()
+        if pos < 0:
+            pos += self.size
+        if pos < 0 or pos > self.size - 1:
             raise IndexError
-        val = self.value[idx.toint().integer()]
-        return SodaString(val)
+        if self.isascii():
+            return ASCII[ord(self.value[pos])]
+        start = self.offset(pos)
+        end = start + charwidth(self.value[start])
+        assert start >= 0
+        return newchar(self.value[start:end])
 
     def setval(self, idx, value):
         raise Exception
 
     def eq(self, other):
         assert isinstance(other, SodaString)
-        if (self.value == other.value):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.value == other.value)
 
     def ne(self, other):
         assert isinstance(other, SodaString)
-        if (self.value != other.value):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.value != other.value)
 
     def gt(self, other):
         assert isinstance(other, SodaString)
-        if (self.value > other.value):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.value > other.value)
 
     def lt(self, other):
         assert isinstance(other, SodaString)
-        if (self.value < other.value):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.value < other.value)
 
     def ge(self, other):
         assert isinstance(other, SodaString)
-        if (self.value >= other.value):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.value >= other.value)
 
     def le(self, other):
         assert isinstance(other, SodaString)
-        if (self.value <= other.value):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.value <= other.value)
 
     def land(self, other):
         assert isinstance(other, SodaString)
-        if not (self.value == u"false" or other.value == u"false"):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.istrue() and other.istrue())
 
     def lor(self, other):
         assert isinstance(other, SodaString)
-        if not (self.value == u"false" and other.value == u"false"):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.istrue() or other.istrue())
 
     def lnot(self):
-        if not self.value == u"false":
-            return SodaString(u"false")
-        else:
-            return SodaString(u"true")
+        return newbool(not self.istrue())
+
+    def istrue(self):
+        if self is FALSE:
+            return False
+        elif self is TRUE:
+            return True
+        return not self.value == "false"
 
     def isstr(self):
         return True
@@ -191,90 +282,67 @@ class SodaString(SodaObject):
 
     def toint(self):
         a = rbigint()
-        number = a.fromstr(str(self.value))
-        return SodaInt(number)
+        number = a.fromstr(self.value)
+        return newbigint(number)
 
     def tostr(self):
-        return SodaString(self.value)
+        return self
 
     def str(self):
-        return self.value.encode("utf-8")
+        return self.value
 
 
 class SodaInt(SodaObject):
-    def __init__(self, value):
-        assert isinstance(value, rbigint)
-        self.value = value
-        self.length = None
-
     def add(self, other):
         assert isinstance(other, SodaInt)
-        return SodaInt(self.value.add(other.value))
+        return newbigint(self.tobigint().add(other.tobigint()))
 
     def sub(self, other):
         assert isinstance(other, SodaInt)
-        return SodaInt(self.value.sub(other.value))
+        return newbigint(self.tobigint().sub(other.tobigint()))
 
     def mul(self, other):
         assert isinstance(other, SodaInt)
-        return SodaInt(self.value.mul(other.value))
+        return newbigint(self.tobigint().mul(other.tobigint()))
 
     def div(self, other):
         assert isinstance(other, SodaInt)
-        return SodaInt(self.value.floordiv(other.value))
+        return newbigint(self.tobigint().floordiv(other.tobigint()))
 
     def mod(self, other):
         assert isinstance(other, SodaInt)
-        return SodaInt(self.value.mod(other.value))
+        return newbigint(self.tobigint().mod(other.tobigint()))
 
     def pow(self, other):
         assert isinstance(other, SodaInt)
-        return SodaInt(self.value.pow(other.value))
+        return newbigint(self.tobigint().pow(other.tobigint()))
 
     def eq(self, other):
         assert isinstance(other, SodaInt)
-        if (self.value.eq(other.value)):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.tobigint().eq(other.tobigint()))
 
     def ne(self, other):
         assert isinstance(other, SodaInt)
-        if (self.value.ne(other.value)):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.tobigint().ne(other.tobigint()))
 
     def gt(self, other):
         assert isinstance(other, SodaInt)
-        if (self.value.gt(other.value)):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.tobigint().gt(other.tobigint()))
 
     def lt(self, other):
         assert isinstance(other, SodaInt)
-        if (self.value.lt(other.value)):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.tobigint().lt(other.tobigint()))
 
     def ge(self, other):
         assert isinstance(other, SodaInt)
-        if (self.value.ge(other.value)):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.tobigint().ge(other.tobigint()))
 
     def le(self, other):
         assert isinstance(other, SodaInt)
-        if (self.value.le(other.value)):
-            return SodaString(u"true")
-        else:
-            return SodaString(u"false")
+        return newbool(self.tobigint().le(other.tobigint()))
 
     def neg(self):
-        return SodaInt(self.value.neg())
+        return newbigint(self.tobigint().neg())
 
     def isstr(self):
         return False
@@ -285,15 +353,24 @@ class SodaInt(SodaObject):
     def isarray(self):
         return False
 
+    def istrue(self):
+        return True
+
     def toint(self):
-        return SodaInt(self.value)
+        return self
+
+    def tobigint(self):
+        raise NotImplementedError
 
     def integer(self):
-        return self.value.toint()
+        raise NotImplementedError
 
     def getkey(self, keypos):
         raise Exception
 
+    def getlength(self):
+        return None
+
     def getval(self, idx):
         raise Exception
 
@@ -301,43 +378,404 @@ class SodaInt(SodaObject):
         raise Exception
 
     def tostr(self):
-        return SodaString(self.str().decode("utf-8"))
+        string = self.str()
+        return SodaString(string, len(string))
+
+
+# integers that fit in a machine word; operations that overflow
+# fall back to the rbigint implementation in SodaInt
+class SodaSmallInt(SodaInt):
+    _immutable_fields_ = ["intval"]
+
+    def __init__(self, intval):
+        self.intval = intval
+
+    def add(self, other):
+        if isinstance(other, SodaSmallInt):
+            try:
+                return SodaSmallInt(ovfcheck(self.intval + other.intval))
+            except OverflowError:
+                pass
+        return SodaInt.add(self, other)
+
+    def sub(self, other):
+        if isinstance(other, SodaSmallInt):
+            try:
+                return SodaSmallInt(ovfcheck(self.intval - other.intval))
+            except OverflowError:
+                pass
+        return SodaInt.sub(self, other)
+
+    def mul(self, other):
+        if isinstance(other, SodaSmallInt):
+            try:
+                return SodaSmallInt(ovfcheck(self.intval * other.intval))
+            except OverflowError:
+                pass
+        return SodaInt.mul(self, other)
+
+    def div(self, other):
+        if isinstance(other, SodaSmallInt):
+            if other.intval == 0:
+                raise ZeroDivisionError
+            try:
+                return SodaSmallInt(ovfcheck(self.intval // other.intval))
+            except OverflowError:
+                pass
+        return SodaInt.div(self, other)
+
+    def mod(self, other):
+        if isinstance(other, SodaSmallInt):
+            if other.intval == 0:
+                raise ZeroDivisionError
+            try:
+                return SodaSmallInt(ovfcheck(self.intval % other.intval))
+            except OverflowError:
+                pass
+        return SodaInt.mod(self, other)
+
+    def pow(self, other):
+        if isinstance(other, SodaSmallInt):
+            if other.intval < 0:
+                raise ValueError
+            try:
+                return SodaSmallInt(intpow(self.intval, other.intval))
+            except OverflowError:
+                pass
+        return SodaInt.pow(self, other)
+
+    def eq(self, other):
+        if isinstance(other, SodaSmallInt):
+            return newbool(self.intval == other.intval)
+        return SodaInt.eq(self, other)
+
+    def ne(self, other):
+        if isinstance(other, SodaSmallInt):
+            return newbool(self.intval != other.intval)
+        return SodaInt.ne(self, other)
+
+    def gt(self, other):
+        if isinstance(other, SodaSmallInt):
+            return newbool(self.intval > other.intval)
+        return SodaInt.gt(self, other)
+
+    def lt(self, other):
+        if isinstance(other, SodaSmallInt):
+            return newbool(self.intval < other.intval)
+        return SodaInt.lt(self, other)
+
+    def ge(self, other):
+        if isinstance(other, SodaSmallInt):
+            return newbool(self.intval >= other.intval)
+        return SodaInt.ge(self, other)
+
+    def le(self, other):
+        if isinstance(other, SodaSmallInt):
+            return newbool(self.intval <= other.intval)
+        return SodaInt.le(self, other)
+
+    def neg(self):
+        try:
+            return SodaSmallInt(ovfcheck(-self.intval))
+        except OverflowError:
+            return SodaInt.neg(self)
+
+    def tobigint(self):
+        return rbigint.fromint(self.intval)
+
+    def integer(self):
+        return self.intval
+
+    def str(self):
+        return str(self.intval)
+
+
+class SodaBigInt(SodaInt):
+    _immutable_fields_ = ["bigval"]
+
+    def __init__(self, bigval):
+        assert isinstance(bigval, rbigint)
+        self.bigval = bigval
+
+    def tobigint(self):
+        return self.bigval
+
+    def integer(self):
+        return self.bigval.toint()
 
     def str(self):
-        s = self.value.str()
-        return unicode(s).encode("utf-8")
+        return self.bigval.str()
+
+
+def newint(intval):
+    return SodaSmallInt(intval)
+
+
+# demotes to a machine word whenever the value fits
+def newbigint(bigval):
+    try:
+        return SodaSmallInt(bigval.toint())
+    except OverflowError:
+        return SodaBigInt(bigval)
+
+
+# every comparison and logical operator returns one of these two objects,
+# so truth tests on their results never have to look at the string
+TRUE = SodaString("true", 4)
+FALSE = SodaString("false", 5)
+EMPTY = SodaString("", 0)
+
+# one shared string for each ASCII character
+ASCII = [SodaString(chr(code), 1) for code in range(128)]
+
+
+# the string holding just the codepoint char encodes
+def newchar(char):
+    if len(char) == 1 and ord(char[0]) < 0x80:
+        return ASCII[ord(char[0])]
+    return SodaString(char, 1)
+
+
+def newbool(value):
+    if value:
+        return TRUE
+    return FALSE
+
+
+def intpow(base, exponent):
+    result = 1
+    while exponent > 0:
+        if exponent & 1:
+            result = ovfcheck(result * base)
+        exponent >>= 1
+        if exponent == 0:
+            break
+        base = ovfcheck(base * base)
+    return result
+
+
+# the text a key is looked up by when it does not read as a machine int
+def keytext(key):
+    if isinstance(key, SodaString):
+        return key.value
+    return key.str()
+
+
+# the machine int a key reads as in decimal, so that a[1] and a["1"]
+# name the same element; the flag is False when it reads as none
+def intkey(key):
+    if isinstance(key, SodaSmallInt):
+        return (True, key.intval)
+    text = keytext(key)
+    negative = text.startswith("-")
+    start = 0
+    if negative:
+        start = 1
+    if start == len(text) or text == "-0":
+        return (False, 0)
+    if text[start] == "0" and len(text) > start + 1:
+        return (False, 0)
+    # accumulated negated, since the most negative int has no opposite
+    result = 0
+    for i in range(start, len(text)):
+        char = text[i]
+        if char < "0" or char > "9":
+            return (False, 0)
+        try:
+            result = ovfcheck(result * 10)
+            result = ovfcheck(result - (ord(char) - ord("0")))
+        except OverflowError:
+            return (False, 0)
+    if not negative:
+        try:
+            result = ovfcheck(-result)
+        except OverflowError:
+            return (False, 0)
+    return (True, result)
+
+
+# the position in a dense array that key names, or -1 when it names none
+def position(key):
+    isint, intval = intkey(key)
+    if not isint or intval < 0:
+        return -1
+    return intval
+
+
+# how an array keeps its elements. every array starts with its keys
+# exactly 0 to n - 1, stored in a list, unboxed while every element is
+# a machine int; the first key or element a strategy cannot hold moves
+# the array to a more general one for good
+class ArrayStrategy(object):
+    def getval(self, array, idx):
+        raise NotImplementedError
+
+    def setval(self, array, idx, value):
+        raise NotImplementedError
+
+    def getkey(self, array, keypos):
+        raise NotImplementedError
+
+    def size(self, array):
+        raise NotImplementedError
+
+    def str(self, array):
+        s = []
+        for i in range(self.size(array)):
+            s.append("\"" + str(i) + "\" : "
+                     "\"" + self.getval(array, newint(i)).str() + "\"")
+        return "[" + ", ".join(s) + "]"
+
+
+class IntStrategy(ArrayStrategy):
+    def getval(self, array, idx):
+        pos = position(idx)
+        if pos == -1 or pos >= len(array.ints):
+            return EMPTY
+        return newint(array.ints[pos])
+
+    def setval(self, array, idx, value):
+        pos = position(idx)
+        if pos == -1 or pos > len(array.ints):
+            array.tomap()
+            array.strategy.setval(array, idx, value)
+        elif not isinstance(value, SodaSmallInt):
+            array.toobjects()
+            array.strategy.setval(array, idx, value)
+        elif pos == len(array.ints):
+            array.ints.append(value.intval)
+        else:
+            array.ints[pos] = value.intval
+
+    def getkey(self, array, keypos):
+        if keypos < len(array.ints):
+            return newint(keypos)
+        return None
+
+    def size(self, array):
+        return len(array.ints)
+
+
+class ObjectStrategy(ArrayStrategy):
+    def getval(self, array, idx):
+        pos = position(idx)
+        if pos == -1 or pos >= len(array.items):
+            return EMPTY
+        return array.items[pos]
+
+    def setval(self, array, idx, value):
+        pos = position(idx)
+        if pos == -1 or pos > len(array.items):
+            array.tomap()
+            array.strategy.setval(array, idx, value)
+        elif pos == len(array.items):
+            array.items.append(value)
+        else:
+            array.items[pos] = value
+
+    def getkey(self, array, keypos):
+        if keypos < len(array.items):
+            return newint(keypos)
+        return None
+
+    def size(self, array):
+        return len(array.items)
+
+
+# any keys at all: those that read as machine ints are looked up by
+# that int and the rest by their text. keys and elements are appended to
+# the lists in the order their keys were first set, with numbered and
+# named mapping each key to where it is in them; soda never removes a
+# key, so the lists never have holes
+class MapStrategy(ArrayStrategy):
+    def find(self, array, idx):
+        isint, intval = intkey(idx)
+        if isint:
+            return array.numbered.get(intval, -1)
+        return array.named.get(keytext(idx), -1)
+
+    def getval(self, array, idx):
+        pos = self.find(array, idx)
+        if pos == -1:
+            return EMPTY
+        return array.items[pos]
+
+    def setval(self, array, idx, value):
+        isint, intval = intkey(idx)
+        if isint:
+            pos = array.numbered.get(intval, -1)
+            if pos == -1:
+                array.numbered[intval] = len(array.keys)
+        else:
+            text = keytext(idx)
+            pos = array.named.get(text, -1)
+            if pos == -1:
+                array.named[text] = len(array.keys)
+        if pos != -1:
+            array.items[pos] = value
+            return
+        array.keys.append(idx)
+        array.items.append(value)
+
+    def getkey(self, array, keypos):
+        if keypos < len(array.keys):
+            return array.keys[keypos]
+        return None
+
+    def size(self, array):
+        return len(array.keys)
+
+    def str(self, array):
+        s = []
+        for i in range(len(array.keys)):
+            s.append("\"" + array.keys[i].str() + "\" : "
+                     "\"" + array.items[i].str() + "\"")
+        return "[" + ", ".join(s) + "]"
+
+
+intstrategy = IntStrategy()
+objectstrategy = ObjectStrategy()
+mapstrategy = MapStrategy()
 
 
 class SodaArray(SodaObject):
     def __init__(self, itemlist):
-        self.value = {}
+        self.strategy = intstrategy
+        self.ints = []
+        self.items = []
+        self.numbered = {}
+        self.named = {}
         self.keys = []
         i = 0
         while i < len(itemlist):
-            self.value[itemlist[i].str()] = itemlist[i + 1]
-            self.keys.append(itemlist[i])
+            self.strategy.setval(self, itemlist[i], itemlist[i + 1])
             i += 2
-        a = rbigint()
-        self.length = SodaInt(a.fromint(len(self.value)))
+
+    def toobjects(self):
+        for intval in self.ints:
+            self.items.append(newint(intval))
+        self.ints = []
+        self.strategy = objectstrategy
+
+    def tomap(self):
+        if self.strategy is intstrategy:
+            self.toobjects()
+        for i in range(len(self.items)):
+            self.numbered[i] = i
+            self.keys.append(newint(i))
+        self.strategy = mapstrategy
 
     def getkey(self, keypos):
-        if keypos < len(self.keys):
-            key = self.keys[keypos]
-        else:
-            key = None
-        return key
+        return self.strategy.getkey(self, keypos)
+
+    def getlength(self):
+        return newint(self.strategy.size(self))
 
     def getval(self, idx):
-        try:
-            return self.value[idx.str()]
-        except KeyError:
-            return SodaString(u"")
+        return self.strategy.getval(self, idx)
 
     def setval(self, idx, value):
-        self.value[idx.str()] = value
-        self.keys.append(idx)
-        a = rbigint()
-        self.length = SodaInt(a.fromint(len(self.value)))
+        self.strategy.setval(self, idx, value)
 
     def isstr(self):
         return False
@@ -348,6 +786,9 @@ class SodaArray(SodaObject):
     def isarray(self):
         return True
 
+    def istrue(self):
+        return True
+
     def toint(self):
         raise Exception
 
@@ -355,47 +796,30 @@ class SodaArray(SodaObject):
         raise Exception
 
     def str(self):
-        s = []
-        for key in self.value:
-            val = self.value[key]
-            s.append("\"" + key + "\" : "
-                     "\"" + val.str() + "\"")
-        return unicode("[" + ", ".join(s) +
-                       "]").encode("utf-8")
+        return self.strategy.str(self)
+
+
+class SodaIterator(SodaObject):
+    def __init__(self, array):
+        self.array = array
+        self.index = 0
+
+    def next(self):
+        key = self.array.getkey(self.index)
+        if key is not None:
+            self.index += 1
+        return key
 
 
 class SodaFunction(SodaObject):
+    _immutable_fields_ = ["name", "arity", "package", "bytecode"]
+
     def __init__(self, name, arity, compiler, package, line, col):
         self.name = name
         self.arity = arity
-        self.numargs = arity
         self.isvariadic = False
         self.compiler = compiler
-        self.constbuffer = []
+        self.bytecode = None
         self.package = package
         self.line = line
         self.col = col
-
-    def evaluate_args(self, argstack):
-        argstack.reverse()
-        if self.isvariadic:
-            a = rbigint()
-            enumlist = []
-            nargstack = []
-            j = 0
-            for i in range(self.arity - 1, len(argstack)):
-                enumlist.append(SodaInt(a.fromint(j)))
-                enumlist.append(argstack[i])
-                j += 1
-            for k in range(0, self.arity - 1):
-                nargstack.append(argstack[k])
-            argstack = nargstack
-            argstack.append(SodaArray(enumlist))
-        for i in range(0, len(self.compiler.constants)):
-            self.constbuffer.append(self.compiler.constants[i])
-            if isinstance(self.compiler.constants[i], SodaDummy):
-                self.compiler.constants[i] = argstack.pop()
-
-    def revert_state(self):
-        self.compiler.constants = self.constbuffer
-        self.constbuffer = []
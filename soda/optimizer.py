@@ -0,0 +1,1211 @@
+# Phillip Wells
+# CSCI-200 Algorithm Analysis
+
+# optimizer.py defines the pass manager that runs
+# optimization passes over the compiler's basic blocks
+
+from soda import bytecode
+from soda.bytecode import Instruction
+from soda.objects import SodaString, SodaSmallInt, SodaInt, newbool
+from soda.objects import SodaFunction, TRUE, FALSE
+from soda.interpreter import outputstream
+
+
+class Pass(object):
+    # lowest optimization level the pass runs at
+    level = 1
+
+    def run(self, compiler):
+        raise NotImplementedError
+
+
+class PassManager(object):
+    def __init__(self):
+        self.level = 1
+        self.passes = []
+
+    def setlevel(self, level):
+        self.level = level
+
+    def addpass(self, optpass):
+        self.passes.append(optpass)
+
+    def run(self, compiler):
+        for optpass in self.passes:
+            if optpass.level <= self.level:
+                optpass.run(compiler)
+
+
+# the most instructions a function body can have and still be inlined
+INLINE_LIMIT = 32
+
+
+def compare(code, left, right):
+    if code == bytecode.EQ:
+        return left.eq(right)
+    elif code == bytecode.NE:
+        return left.ne(right)
+    elif code == bytecode.GT:
+        return left.gt(right)
+    elif code == bytecode.LT:
+        return left.lt(right)
+    elif code == bytecode.GE:
+        return left.ge(right)
+    return left.le(right)
+
+
+def arithmetic(code, left, right):
+    if code == bytecode.ADD:
+        return left.add(right)
+    elif code == bytecode.SUB:
+        return left.sub(right)
+    elif code == bytecode.MUL:
+        return left.mul(right)
+    elif code == bytecode.DIV:
+        return left.div(right)
+    elif code == bytecode.MOD:
+        return left.mod(right)
+    return left.pow(right)
+
+
+# evaluates a binary opcode on two constants the way the interpreter does,
+# with left being the operand on top of the stack; returns None whenever
+# the interpreter would report an error, so that it still does at runtime
+def foldbinary(code, left, right):
+    if code == bytecode.CONCAT or code == bytecode.DIFF:
+        try:
+            left = left.tostr()
+            right = right.tostr()
+        except Exception:
+            return None
+        assert isinstance(left, SodaString)
+        assert isinstance(right, SodaString)
+        if code == bytecode.DIFF:
+            return left.diff(right)
+        # concatenation builds a SodaBuilder at runtime; a finished
+        # string reads the same and stays immutable as a constant
+        return SodaString(left.value + right.value, left.size + right.size)
+    elif code in bytecode.INT_VARIANT and code not in bytecode.STR_VARIANT:
+        try:
+            if not left.isint():
+                left = left.toint()
+            if not right.isint():
+                right = right.toint()
+        except Exception:
+            return None
+        if code == bytecode.POW:
+            if not isinstance(right, SodaSmallInt) or right.intval > 64:
+                return None
+        try:
+            return arithmetic(code, left, right)
+        except ZeroDivisionError:
+            return None
+        except ValueError:
+            return None
+    elif code in bytecode.STR_VARIANT:
+        if left.isstr() and right.isstr() or left.isint()\
+           and right.isint():
+            return compare(code, left, right)
+        try:
+            left = left.toint()
+            right = right.toint()
+            return compare(code, left, right)
+        except Exception:
+            try:
+                left = left.tostr()
+                right = right.tostr()
+                return compare(code, left, right)
+            except Exception:
+                return None
+    return None
+
+
+def foldunary(code, operand):
+    if code == bytecode.NEG:
+        if not operand.isint():
+            try:
+                operand = operand.toint()
+            except Exception:
+                return None
+        return operand.neg()
+    elif code == bytecode.NOT:
+        return newbool(not operand.istrue())
+    elif code == bytecode.BOOL:
+        return newbool(operand.istrue())
+    elif code == bytecode.LEN:
+        if isinstance(operand, SodaString):
+            return operand.getlength()
+    return None
+
+
+def copyblocks(blocks):
+    copies = []
+    for block in blocks:
+        copy = bytecode.Block()
+        block.index = len(copies)
+        copies.append(copy)
+    for block in blocks:
+        copy = copies[block.index]
+        for instruction in block.instructions:
+            target = instruction.target
+            if target is not None:
+                target = copies[target.index]
+            copy.instructions.append(Instruction(instruction.code,
+                                                 instruction.arg, target,
+                                                 instruction.package,
+                                                 instruction.line,
+                                                 instruction.col))
+    return copies
+
+
+# replaces calls to small functions that are neither recursive nor
+# variadic with a copy of their body, whichever package they are from;
+# arguments are stored into fresh variables standing in for the
+# parameters and each return jumps past the inlined body. it runs first,
+# and then keeps a copy of the result for the functions calling this one
+class Inlining(Pass):
+    level = 2
+
+    def run(self, compiler):
+        i = 0
+        while i < len(compiler.blocks):
+            i = self.inlineblock(compiler, i)
+        compiler.inlinebody = copyblocks(compiler.blocks)
+
+    def inlinable(self, function):
+        if function.isvariadic or outputstream(function) != 0:
+            return False
+        callee = function.compiler
+        if callee is None or callee.inlinebody is None:
+            return False
+        size = 0
+        for block in callee.inlinebody:
+            for instruction in block.instructions:
+                if instruction.code == bytecode.CALL and\
+                   instruction.arg >= 0 and\
+                   callee.constants[instruction.arg] is function:
+                    return False
+                size += 1
+        return size <= INLINE_LIMIT
+
+    # inlines the first inlinable call in the block at index; returns the
+    # index of the block to carry on from
+    def inlineblock(self, compiler, index):
+        block = compiler.blocks[index]
+        for k in range(len(block.instructions)):
+            instruction = block.instructions[k]
+            if instruction.code != bytecode.CALL or instruction.arg < 0:
+                continue
+            function = compiler.constants[instruction.arg]
+            assert isinstance(function, SodaFunction)
+            if not self.inlinable(function):
+                continue
+            callee = function.compiler
+            assert callee is not None
+            rest = bytecode.Block()
+            rest.instructions = block.instructions[k + 1:]
+            del block.instructions[k:]
+            varmap = []
+            for i in range(len(callee.variables)):
+                varmap.append(compiler.new_variable())
+            body = self.copybody(compiler, callee, varmap, rest)
+            for i in range(function.arity - 1, -1, -1):
+                block.instructions.append(Instruction(bytecode.STORE_VAR,
+                                                      varmap[i], None,
+                                                      instruction.package,
+                                                      instruction.line,
+                                                      instruction.col))
+            compiler.blocks = compiler.blocks[:index + 1] + body +\
+                [rest] + compiler.blocks[index + 1:]
+            return index + len(body) + 1
+        return index + 1
+
+    def copybody(self, compiler, callee, varmap, rest):
+        body = copyblocks(callee.inlinebody)
+        constmap = [-1] * len(callee.constants)
+        for block in body:
+            for instruction in block.instructions:
+                code = instruction.code
+                if code == bytecode.LOAD_VAR or code == bytecode.STORE_VAR or\
+                   code == bytecode.FOR_LT or code == bytecode.FOR_INC:
+                    if instruction.arg != -1:
+                        instruction.arg = varmap[instruction.arg]
+                elif code == bytecode.LOAD_CONST or\
+                        code == bytecode.CALL and instruction.arg >= 0:
+                    if constmap[instruction.arg] == -1:
+                        constmap[instruction.arg] = self.constant(
+                            compiler, callee.constants[instruction.arg])
+                    instruction.arg = constmap[instruction.arg]
+                elif code == bytecode.RETURN:
+                    instruction.code = bytecode.JUMP
+                    instruction.target = rest
+        return body
+
+    # functions keep the index they already have in the caller
+    def constant(self, compiler, value):
+        if isinstance(value, SodaFunction):
+            return compiler.function_constant(value)
+        return compiler.register_constant(value)
+
+
+# evaluates operators whose operands are all constants at compile time,
+# resolves branches on constant conditions, and replaces loads of
+# variables that are only ever assigned one constant with that constant
+class ConstantFolding(Pass):
+    level = 1
+
+    def run(self, compiler):
+        changed = True
+        while changed:
+            changed = False
+            for block in compiler.blocks:
+                if self.foldblock(compiler, block):
+                    changed = True
+            if self.propagate(compiler):
+                changed = True
+
+    def loadconst(self, compiler, value, instruction):
+        return Instruction(bytecode.LOAD_CONST,
+                           compiler.register_constant(value), None,
+                           instruction.package, instruction.line,
+                           instruction.col)
+
+    def foldblock(self, compiler, block):
+        result = []
+        changed = False
+        for instruction in block.instructions:
+            code = instruction.code
+            if len(result) >= 2 and result[-1].code == bytecode.LOAD_CONST\
+               and result[-2].code == bytecode.LOAD_CONST:
+                left = compiler.constants[result[-1].arg]
+                right = compiler.constants[result[-2].arg]
+                value = foldbinary(code, left, right)
+                if value is not None:
+                    result.pop()
+                    result.pop()
+                    result.append(self.loadconst(compiler, value,
+                                                 instruction))
+                    changed = True
+                    continue
+            if len(result) >= 1 and result[-1].code == bytecode.LOAD_CONST:
+                operand = compiler.constants[result[-1].arg]
+                value = foldunary(code, operand)
+                if value is not None:
+                    result.pop()
+                    result.append(self.loadconst(compiler, value,
+                                                 instruction))
+                    changed = True
+                    continue
+                if self.foldbranch(compiler, instruction, operand, result):
+                    changed = True
+                    continue
+            result.append(instruction)
+        block.instructions = result
+        return changed
+
+    # a branch on a constant either always jumps or never does; the
+    # constant it tested has already been emitted at the end of result
+    def foldbranch(self, compiler, instruction, operand, result):
+        code = instruction.code
+        if code == bytecode.J_IF_TRUE or code == bytecode.J_IF_FALSE:
+            taken = operand.istrue() == (code == bytecode.J_IF_TRUE)
+            result.pop()
+        elif code == bytecode.J_IF_FALSE_OR_POP:
+            taken = not operand.istrue()
+            result.pop()
+            if taken:
+                result.append(self.loadconst(compiler, FALSE, instruction))
+        elif code == bytecode.J_IF_TRUE_OR_POP:
+            taken = operand.istrue()
+            result.pop()
+            if taken:
+                result.append(self.loadconst(compiler, TRUE, instruction))
+        else:
+            return False
+        if taken:
+            result.append(Instruction(bytecode.JUMP, 0, instruction.target,
+                                      instruction.package, instruction.line,
+                                      instruction.col))
+        return True
+
+    def propagate(self, compiler):
+        stores = [0] * len(compiler.variables)
+        constidx = [-1] * len(compiler.variables)
+        for block in compiler.blocks:
+            # constants loaded back to back and then stored back to back,
+            # as inlined arguments are, each reach their own store
+            loaded = []
+            for instruction in block.instructions:
+                if instruction.code == bytecode.STORE_VAR:
+                    stores[instruction.arg] += 1
+                    if loaded != []:
+                        constidx[instruction.arg] = loaded.pop()
+                    continue
+                elif instruction.code == bytecode.FOR_INC:
+                    stores[instruction.arg] += 1
+                if instruction.code == bytecode.LOAD_CONST:
+                    loaded.append(instruction.arg)
+                else:
+                    loaded = []
+        changed = False
+        for block in compiler.blocks:
+            for instruction in block.instructions:
+                if instruction.code != bytecode.LOAD_VAR:
+                    continue
+                idx = instruction.arg
+                # parameters are assigned by every call as well
+                if idx < compiler.numparams or stores[idx] != 1:
+                    continue
+                if constidx[idx] != -1:
+                    instruction.code = bytecode.LOAD_CONST
+                    instruction.arg = constidx[idx]
+                    changed = True
+        return changed
+
+
+# whether calling function can mutate an array, either in its own body
+# or in any function it calls; seen holds the functions already looked
+# at, whose answer is part of the one being worked out
+def mutates(function, seen):
+    if function in seen:
+        return False
+    seen[function] = True
+    callee = function.compiler
+    if callee is None or callee.inlinebody is None:
+        return True
+    for block in callee.inlinebody:
+        for instruction in block.instructions:
+            code = instruction.code
+            if code == bytecode.SET_INDEX:
+                return True
+            if code == bytecode.CALL:
+                if instruction.arg < 0:
+                    return True
+                other = callee.constants[instruction.arg]
+                assert isinstance(other, SodaFunction)
+                if mutates(other, seen):
+                    return True
+    return False
+
+
+# whether instruction can change what an index or a length evaluates to:
+# SET_INDEX can mutate any array, and so can calls unless the callee is
+# known not to
+def clobbers(compiler, instruction):
+    code = instruction.code
+    if code == bytecode.SET_INDEX:
+        return True
+    if code == bytecode.CALL:
+        if instruction.arg < 0:
+            return True
+        function = compiler.constants[instruction.arg]
+        assert isinstance(function, SodaFunction)
+        return mutates(function, {})
+    return False
+
+
+# local value numbering: within a block, a GET_INDEX or LEN applied to
+# the same values as an earlier one still in effect is replaced, along
+# with the loads computing its operands, by a load of a variable the
+# first one's result was saved into
+class CommonSubexpressions(Pass):
+    level = 1
+
+    def run(self, compiler):
+        for block in compiler.blocks:
+            # the first run finds which results are reused, so only
+            # those get a variable to be saved in
+            reused = {}
+            self.numberblock(compiler, block, reused, False)
+            if len(reused) > 0:
+                block.instructions = self.numberblock(compiler, block,
+                                                      reused, True)
+
+    def numberblock(self, compiler, block, reused, rewrite):
+        result = []
+        # value number and the index in result where the instructions
+        # computing it start, or -1 when they cannot be removed
+        stack = []
+        smallints = {}
+        strings = {}
+        constants = {}
+        variables = {}
+        values = {}
+        fresh = 0
+        for instruction in block.instructions:
+            code = instruction.code
+            arg = instruction.arg
+            if code == bytecode.LOAD_CONST:
+                # equal literals are registered as separate constants
+                value = compiler.constants[arg]
+                if isinstance(value, SodaSmallInt):
+                    number = smallints.get(value.intval, -1)
+                elif isinstance(value, SodaString):
+                    number = strings.get(value.value, -1)
+                else:
+                    number = constants.get(arg, -1)
+                if number == -1:
+                    number = fresh
+                    fresh += 1
+                    if isinstance(value, SodaSmallInt):
+                        smallints[value.intval] = number
+                    elif isinstance(value, SodaString):
+                        strings[value.value] = number
+                    else:
+                        constants[arg] = number
+                stack.append((number, len(result)))
+                result.append(instruction)
+            elif code == bytecode.LOAD_VAR and arg != -1:
+                number = variables.get(arg, -1)
+                if number == -1:
+                    number = fresh
+                    fresh += 1
+                    variables[arg] = number
+                stack.append((number, len(result)))
+                result.append(instruction)
+            elif code == bytecode.STORE_VAR:
+                if stack != []:
+                    number, start = stack.pop()
+                else:
+                    number = fresh
+                    fresh += 1
+                variables[arg] = number
+                for i in range(len(stack)):
+                    stack[i] = (stack[i][0], -1)
+                result.append(instruction)
+            elif code == bytecode.GET_INDEX or code == bytecode.LEN:
+                if code == bytecode.GET_INDEX:
+                    count = 2
+                else:
+                    count = 1
+                if len(stack) < count:
+                    stack = []
+                    result.append(instruction)
+                    continue
+                bottom = len(stack) - count
+                assert bottom >= 0
+                first, start = stack[bottom]
+                last, end = stack[-1]
+                removable = start != -1 and end != -1
+                del stack[bottom:]
+                key = (code, first, last)
+                number, temp, origin = values.get(key, (-1, -1, None))
+                if number != -1 and removable and\
+                   (not rewrite or temp != -1):
+                    reused[origin] = True
+                    assert start >= 0
+                    del result[start:]
+                    result.append(Instruction(bytecode.LOAD_VAR, temp, None,
+                                              instruction.package,
+                                              instruction.line,
+                                              instruction.col))
+                    stack.append((number, start))
+                    continue
+                number = fresh
+                fresh += 1
+                temp = -1
+                result.append(instruction)
+                if rewrite and instruction in reused:
+                    temp = compiler.new_variable()
+                    result.append(Instruction(bytecode.STORE_VAR, temp, None,
+                                              "", "", ""))
+                    result.append(Instruction(bytecode.LOAD_VAR, temp, None,
+                                              "", "", ""))
+                values[key] = (number, temp, instruction)
+                if not removable:
+                    start = -1
+                stack.append((number, start))
+            else:
+                if clobbers(compiler, instruction):
+                    values = {}
+                stack = []
+                result.append(instruction)
+        return result
+
+
+# comparisons are total orders, so a branch taken when one holds is a
+# branch not taken when its negation holds
+NEGATED = {
+    bytecode.EQ: bytecode.NE,
+    bytecode.NE: bytecode.EQ,
+    bytecode.GT: bytecode.LE,
+    bytecode.LT: bytecode.GE,
+    bytecode.GE: bytecode.LT,
+    bytecode.LE: bytecode.GT
+}
+
+
+def isbranch(code):
+    return code == bytecode.J_IF_TRUE or code == bytecode.J_IF_FALSE
+
+
+def invert(code):
+    if code == bytecode.J_IF_TRUE:
+        return bytecode.J_IF_FALSE
+    return bytecode.J_IF_TRUE
+
+
+# cleans up after the code generator and the other passes: threads jumps
+# through blocks that only jump again, drops jumps to the next
+# instruction, removes unreachable code and stores that are never loaded,
+# and collapses LOAD_CONST or LOAD_VAR followed by DROP_CONST and
+# STORE_VAR x followed by the only LOAD_VAR x; positions travel with each
+# instruction, so they stay right
+class Peephole(Pass):
+    level = 1
+
+    def run(self, compiler):
+        changed = True
+        while changed:
+            changed = False
+            self.number(compiler)
+            if self.threadjumps(compiler):
+                changed = True
+            if self.removeunreachable(compiler):
+                changed = True
+            self.number(compiler)
+            if self.removejumps(compiler):
+                changed = True
+            if self.collapse(compiler):
+                changed = True
+
+    def number(self, compiler):
+        for block in compiler.blocks:
+            block.targeted = False
+        i = 0
+        for block in compiler.blocks:
+            block.index = i
+            last = block.last()
+            if last is not None and last.target is not None:
+                last.target.targeted = True
+            i += 1
+
+    # the block control actually arrives at when entering block, skipping
+    # empty ones; None means the end of the code
+    def resolve(self, compiler, block):
+        i = block.index
+        while i < len(compiler.blocks):
+            if compiler.blocks[i].instructions != []:
+                return compiler.blocks[i]
+            i += 1
+        return None
+
+    def following(self, compiler, block):
+        if block.index + 1 < len(compiler.blocks):
+            return self.resolve(compiler, compiler.blocks[block.index + 1])
+        return None
+
+    def threadjumps(self, compiler):
+        changed = False
+        for block in compiler.blocks:
+            last = block.last()
+            if last is None or last.target is None:
+                continue
+            target = last.target
+            hops = 0
+            while hops < len(compiler.blocks):
+                resolved = self.resolve(compiler, target)
+                if resolved is None:
+                    break
+                first = resolved.instructions[0]
+                if first.code != bytecode.JUMP or first.target is None:
+                    break
+                if first.target is target:
+                    break
+                target = first.target
+                hops += 1
+            if target is not last.target:
+                last.target = target
+                changed = True
+        return changed
+
+    def removeunreachable(self, compiler):
+        changed = False
+        # nothing runs after a jump or a return within a block
+        for block in compiler.blocks:
+            i = 0
+            while i < len(block.instructions):
+                if bytecode.endsblock(block.instructions[i].code):
+                    break
+                i += 1
+            if i + 1 < len(block.instructions):
+                del block.instructions[i + 1:]
+                changed = True
+        reachable = [False] * len(compiler.blocks)
+        pending = [compiler.blocks[0]]
+        while pending:
+            block = pending.pop()
+            if reachable[block.index]:
+                continue
+            reachable[block.index] = True
+            last = block.last()
+            if last is not None and last.target is not None:
+                pending.append(last.target)
+            if block.fallsthrough() and block.index + 1 < len(compiler.blocks):
+                pending.append(compiler.blocks[block.index + 1])
+        blocks = []
+        for block in compiler.blocks:
+            if reachable[block.index]:
+                blocks.append(block)
+            else:
+                changed = True
+        compiler.blocks = blocks
+        return changed
+
+    def removejumps(self, compiler):
+        changed = False
+        for block in compiler.blocks:
+            last = block.last()
+            if last is None or last.target is None:
+                continue
+            following = self.following(compiler, block)
+            target = self.resolve(compiler, last.target)
+            if target is following:
+                if last.code == bytecode.JUMP:
+                    block.instructions.pop()
+                    changed = True
+                elif isbranch(last.code):
+                    last.code = bytecode.DROP_CONST
+                    last.target = None
+                    changed = True
+                continue
+            # a branch over a lone jump becomes the opposite branch
+            if isbranch(last.code) and following is not None and\
+               len(following.instructions) == 1 and not following.targeted:
+                jump = following.instructions[0]
+                if jump.code == bytecode.JUMP and jump.target is not None\
+                   and target is self.following(compiler, following):
+                    last.code = invert(last.code)
+                    last.target = jump.target
+                    following.instructions = []
+                    changed = True
+        return changed
+
+    def collapse(self, compiler):
+        loads = [0] * len(compiler.variables)
+        for block in compiler.blocks:
+            for instruction in block.instructions:
+                if instruction.code == bytecode.LOAD_VAR and\
+                   instruction.arg != -1 or\
+                   instruction.code == bytecode.FOR_LT or\
+                   instruction.code == bytecode.FOR_INC:
+                    loads[instruction.arg] += 1
+        changed = False
+        for block in compiler.blocks:
+            result = []
+            for instruction in block.instructions:
+                # a store nothing ever loads only needs to pop its value
+                if instruction.code == bytecode.STORE_VAR and\
+                   loads[instruction.arg] == 0:
+                    instruction.code = bytecode.DROP_CONST
+                    instruction.arg = 0
+                    changed = True
+                if result != []:
+                    previous = result[-1]
+                    if instruction.code == bytecode.DROP_CONST and\
+                       (previous.code == bytecode.LOAD_CONST or
+                        previous.code == bytecode.LOAD_VAR and
+                        previous.arg != -1):
+                        result.pop()
+                        changed = True
+                        continue
+                    if instruction.code == bytecode.LOAD_VAR and\
+                       previous.code == bytecode.STORE_VAR and\
+                       previous.arg == instruction.arg and\
+                       loads[instruction.arg] == 1:
+                        result.pop()
+                        changed = True
+                        continue
+                result.append(instruction)
+            block.instructions = result
+        return changed
+
+
+# what the type inference knows about a value: it is never assigned
+# before this point, it is certainly a SodaInt or a SodaString, or it
+# could be anything
+T_NONE = 0
+T_INT = 1
+T_STR = 2
+T_ANY = 3
+
+
+# a variable only assigned along some of the paths joining here could
+# still be unassigned, so it is no longer certainly an int or a string
+def jointype(left, right):
+    if left == right:
+        return left
+    return T_ANY
+
+
+def consttype(value):
+    if isinstance(value, SodaInt):
+        return T_INT
+    elif isinstance(value, SodaString):
+        return T_STR
+    return T_ANY
+
+
+# result types of the operators whose result type never depends on their
+# operands; comparisons and logic produce TRUE or FALSE, both strings
+RESULT_TYPE = {
+    bytecode.ADD: T_INT,
+    bytecode.SUB: T_INT,
+    bytecode.MUL: T_INT,
+    bytecode.DIV: T_INT,
+    bytecode.MOD: T_INT,
+    bytecode.POW: T_INT,
+    bytecode.NEG: T_INT,
+    bytecode.LEN: T_INT,
+    bytecode.DIFF: T_STR,
+    bytecode.EQ: T_STR,
+    bytecode.NE: T_STR,
+    bytecode.GT: T_STR,
+    bytecode.LT: T_STR,
+    bytecode.GE: T_STR,
+    bytecode.LE: T_STR,
+    bytecode.NOT: T_STR,
+    bytecode.BOOL: T_STR
+}
+
+# opcodes that leave a value nothing is known about
+RESULT_ANY = {
+    bytecode.CONCAT: True,
+    bytecode.CALL: True,
+    bytecode.STOR_ARRAY: True,
+    bytecode.PACK_VARGS: True,
+    bytecode.GET_INDEX: True,
+    bytecode.GET_ITER: True,
+    bytecode.CHARS: True,
+    bytecode.WORDS: True,
+    bytecode.LINES: True
+}
+
+
+class TypeState(object):
+    def __init__(self, stack, variables):
+        self.stack = stack
+        self.variables = variables
+
+    def copy(self):
+        return TypeState(self.stack[:], self.variables[:])
+
+    # merges other into this state; returns whether anything widened
+    def join(self, other):
+        changed = False
+        for i in range(len(self.stack)):
+            joined = jointype(self.stack[i], other.stack[i])
+            if joined != self.stack[i]:
+                self.stack[i] = joined
+                changed = True
+        for i in range(len(self.variables)):
+            joined = jointype(self.variables[i], other.variables[i])
+            if joined != self.variables[i]:
+                self.variables[i] = joined
+                changed = True
+        return changed
+
+
+# proves the types of stack values and variables at every instruction by
+# running the blocks to a fixpoint over T_INT, T_STR and T_ANY, then
+# rewrites operators whose operands are proven ints or strings into the
+# typed opcodes, which skip the coercions the generic ones make
+class TypeInference(Pass):
+    level = 1
+
+    def run(self, compiler):
+        i = 0
+        for block in compiler.blocks:
+            block.index = i
+            i += 1
+        states = [None] * len(compiler.blocks)
+        variables = [T_NONE] * len(compiler.variables)
+        for i in range(compiler.numparams):
+            variables[i] = T_ANY
+        states[0] = TypeState([], variables)
+        pending = [0]
+        while pending:
+            index = pending.pop()
+            state = states[index].copy()
+            for successor, out in self.walk(compiler, compiler.blocks[index],
+                                            state, False):
+                if states[successor] is None:
+                    states[successor] = out
+                    pending.append(successor)
+                elif len(states[successor].stack) != len(out.stack):
+                    # blocks are only ever entered at one depth
+                    return
+                elif states[successor].join(out):
+                    pending.append(successor)
+        for block in compiler.blocks:
+            state = states[block.index]
+            if state is not None:
+                self.walk(compiler, block, state.copy(), True)
+
+    # runs state through block, retyping its operators when rewrite is
+    # set; returns the states leaving it for each successor's index
+    def walk(self, compiler, block, state, rewrite):
+        edges = []
+        stack = state.stack
+        variables = state.variables
+        for instruction in block.instructions:
+            code = instruction.code
+            arg = instruction.arg
+            if code == bytecode.LOAD_CONST:
+                stack.append(consttype(compiler.constants[arg]))
+            elif code == bytecode.LOAD_VAR:
+                if arg == -1:
+                    return edges
+                stack.append(variables[arg])
+            elif code == bytecode.STORE_VAR:
+                variables[arg] = stack.pop()
+            elif code == bytecode.FOR_INC:
+                variables[arg] = T_INT
+            elif code in RESULT_TYPE:
+                if code == bytecode.NEG or code == bytecode.NOT or\
+                   code == bytecode.BOOL or code == bytecode.LEN:
+                    operand = stack.pop()
+                    if rewrite and code == bytecode.NEG and operand == T_INT:
+                        instruction.code = bytecode.NEG_INT
+                else:
+                    right = stack.pop()
+                    left = stack.pop()
+                    if rewrite:
+                        self.retype(instruction, left, right)
+                stack.append(RESULT_TYPE[code])
+            elif code == bytecode.CALL and arg < 0:
+                return edges
+            elif code == bytecode.JUMP and instruction.target is None:
+                return edges
+            elif code in RESULT_ANY:
+                effect = compiler.stack_effect(code, arg)
+                for i in range(1 - effect):
+                    stack.pop()
+                stack.append(T_ANY)
+            elif code == bytecode.J_IF_FALSE_OR_POP or\
+                    code == bytecode.J_IF_TRUE_OR_POP:
+                stack.pop()
+                taken = TypeState(stack[:], variables[:])
+                taken.stack.append(T_STR)
+                edges.append((instruction.target.index, taken))
+                continue
+            elif code == bytecode.ITERATE:
+                exhausted = TypeState(stack[:-1], variables[:])
+                edges.append((instruction.target.index, exhausted))
+                stack.append(T_ANY)
+                continue
+            else:
+                for i in range(-compiler.stack_effect(code, arg)):
+                    stack.pop()
+            if instruction.target is not None:
+                edges.append((instruction.target.index,
+                              TypeState(stack[:], variables[:])))
+        if block.fallsthrough() and block.index + 1 < len(compiler.blocks):
+            edges.append((block.index + 1, TypeState(stack, variables)))
+        return edges
+
+    def retype(self, instruction, left, right):
+        code = instruction.code
+        if left == T_INT and right == T_INT and code in bytecode.INT_TYPED:
+            instruction.code = bytecode.INT_TYPED[code]
+        elif left == T_STR and right == T_STR and\
+                code in bytecode.STR_TYPED:
+            instruction.code = bytecode.STR_TYPED[code]
+
+
+# operators that compute a value from nothing but their operands, with
+# how many they pop; GET_INDEX and LEN also read the array they are given
+PURE = {
+    bytecode.GET_INDEX: 2,
+    bytecode.LEN: 1,
+    bytecode.NEG: 1,
+    bytecode.NOT: 1,
+    bytecode.BOOL: 1,
+    bytecode.NEG_INT: 1
+}
+for code in [bytecode.ADD, bytecode.DIFF, bytecode.SUB, bytecode.MUL,
+             bytecode.DIV, bytecode.MOD, bytecode.POW, bytecode.EQ,
+             bytecode.NE, bytecode.GT, bytecode.LT, bytecode.GE, bytecode.LE]:
+    PURE[code] = 2
+for code in bytecode.INT_TYPED.values() + bytecode.STR_TYPED.values():
+    if code != bytecode.NEG_INT:
+        PURE[code] = 2
+
+# the typed operators that cannot report an error, so they can be run
+# before the point they would have been
+SAFE = {
+    bytecode.NEG_INT: True
+}
+for code in bytecode.STR_TYPED.values() + [bytecode.ADD_INT, bytecode.SUB_INT,
+                                           bytecode.MUL_INT, bytecode.EQ_INT,
+                                           bytecode.NE_INT, bytecode.GT_INT,
+                                           bytecode.LT_INT, bytecode.GE_INT,
+                                           bytecode.LE_INT]:
+    SAFE[code] = True
+
+
+# moves expressions whose value cannot change while a loop runs into a
+# preheader block run once before it, saving them into fresh variables.
+# a loop is the blocks from the target of a jump back up to that jump,
+# entered only through its first block; everything the first block
+# computes before it can report an error or do anything else runs once
+# per entry anyway, so any invariant expression there moves, while the
+# rest of the loop only gives up typed operators that cannot fail. an
+# index or a length is only invariant when nothing in the loop clobbers
+class LoopInvariantMotion(Pass):
+    level = 2
+
+    def run(self, compiler):
+        blocks = compiler.blocks
+        for i in range(len(blocks)):
+            blocks[i].index = i
+        # the head of each loop in the order their first jump back is met,
+        # the last block jumping back to each, and the blocks jumping to
+        # each block
+        heads = []
+        latches = {}
+        jumps = {}
+        for block in blocks:
+            last = block.last()
+            if last is None or last.target is None:
+                continue
+            target = last.target
+            if target in jumps:
+                jumps[target].append(block)
+            else:
+                jumps[target] = [block]
+            if target.index <= block.index:
+                if target not in latches:
+                    heads.append(target)
+                latches[target] = block
+        # the heads of the loops each block lies inside, past their head
+        inside = []
+        for block in blocks:
+            inside.append([])
+        for head in heads:
+            for i in range(head.index + 1, latches[head].index + 1):
+                inside[i].append(head)
+        # loops with a jump into them from outside, other than to the head
+        entered = {}
+        for block in blocks:
+            last = block.last()
+            if last is None or last.target is None:
+                continue
+            for head in inside[last.target.index]:
+                if not head.index <= block.index <= latches[head].index:
+                    entered[head] = True
+        # inner loops jump back first, so their code moves out of the
+        # outer ones' too where it can; preheaders are kept by the head
+        # they come before and spliced in once every loop is done
+        preheaders = {}
+        for head in heads:
+            if head not in entered:
+                self.hoist(compiler, head, latches[head], jumps, preheaders)
+        result = []
+        for block in blocks:
+            if block in preheaders:
+                result.append(preheaders[block])
+            result.append(block)
+        compiler.blocks = result
+
+    def hoist(self, compiler, head, latch, jumps, preheaders):
+        first = head.index
+        last = latch.index
+        # the preheaders of the loops nested in this one are part of it
+        body = []
+        for i in range(first, last + 1):
+            block = compiler.blocks[i]
+            if block in preheaders:
+                body.append(preheaders[block])
+            body.append(block)
+        stored = {}
+        clobbered = False
+        for block in body:
+            for instruction in block.instructions:
+                if instruction.code == bytecode.STORE_VAR or\
+                   instruction.code == bytecode.FOR_INC:
+                    stored[instruction.arg] = True
+                elif clobbers(compiler, instruction):
+                    clobbered = True
+        preheader = bytecode.Block()
+        for block in body:
+            block.instructions = self.extract(compiler, block, block is head,
+                                              stored, clobbered, preheader)
+        if preheader.instructions == []:
+            return
+        for block in jumps.get(head, []):
+            if not first <= block.index <= last:
+                block.last().target = preheader
+        preheaders[head] = preheader
+
+    # moves the invariant expressions in block into preheader and returns
+    # its instructions with each replaced by a load of where it was saved
+    def extract(self, compiler, block, ishead, stored, clobbered,
+                preheader):
+        instructions = block.instructions
+        # the index where each span to move starts holds where it ends
+        ends = [-1] * len(instructions)
+        # for each value on the stack, where the instructions computing it
+        # start, whether it is invariant, and whether they do any work
+        starts = []
+        invariant = []
+        computed = []
+        k = 0
+        while k < len(instructions):
+            instruction = instructions[k]
+            code = instruction.code
+            arg = instruction.arg
+            if code == bytecode.LOAD_CONST:
+                starts.append(k)
+                invariant.append(True)
+                computed.append(False)
+            elif code == bytecode.LOAD_VAR and arg != -1:
+                starts.append(k)
+                invariant.append(arg not in stored)
+                computed.append(False)
+            elif code in PURE and len(starts) >= PURE[code] and\
+                    (ishead or code in SAFE):
+                bottom = len(starts) - PURE[code]
+                assert bottom >= 0
+                moves = True
+                for j in range(bottom, len(starts)):
+                    if not invariant[j]:
+                        moves = False
+                if code == bytecode.GET_INDEX or code == bytecode.LEN:
+                    if clobbered:
+                        moves = False
+                if not moves and code not in SAFE:
+                    # nothing after something that can fail moves above it
+                    self.mark(ends, starts, invariant, computed, 0, k)
+                    break
+                if not moves:
+                    self.mark(ends, starts, invariant, computed, bottom, k)
+                start = starts[bottom]
+                del starts[bottom:]
+                del invariant[bottom:]
+                del computed[bottom:]
+                starts.append(start)
+                invariant.append(moves)
+                computed.append(True)
+            else:
+                self.mark(ends, starts, invariant, computed, 0, k)
+                if ishead:
+                    break
+                starts = []
+                invariant = []
+                computed = []
+            k += 1
+        if k == len(instructions):
+            self.mark(ends, starts, invariant, computed, 0, k)
+        result = []
+        k = 0
+        while k < len(instructions):
+            end = ends[k]
+            if end == -1:
+                result.append(instructions[k])
+                k += 1
+                continue
+            assert end >= k
+            preheader.instructions.extend(instructions[k:end])
+            temp = compiler.new_variable()
+            source = instructions[end - 1]
+            preheader.instructions.append(Instruction(bytecode.STORE_VAR, temp,
+                                                      None, "", "", ""))
+            result.append(Instruction(bytecode.LOAD_VAR, temp, None,
+                                      source.package, source.line,
+                                      source.col))
+            k = end
+        return result
+
+    # marks the invariant values on the stack from bottom up, whose last
+    # one is computed by the instructions before end, to be moved
+    def mark(self, ends, starts, invariant, computed, bottom, end):
+        for j in range(bottom, len(starts)):
+            if invariant[j] and computed[j]:
+                if j + 1 < len(starts):
+                    ends[starts[j]] = starts[j + 1]
+                else:
+                    ends[starts[j]] = end
+
+
+# fuses the sequences that dominate loops into single opcodes: x := x + c
+# becomes INC_VAR, a comparison feeding a branch becomes a J_UNLESS_*
+# branch, LOAD_VAR followed by GET_INDEX becomes INDEX_VAR, and two
+# LOAD_VARs become LOAD_VARS; it runs last, once nothing else needs to
+# see the plain opcodes
+class Superinstructions(Pass):
+    level = 1
+
+    def run(self, compiler):
+        for block in compiler.blocks:
+            block.instructions = self.fuse(block.instructions)
+
+    def fuse(self, instructions):
+        result = []
+        i = 0
+        while i < len(instructions):
+            fused, length = self.match(instructions, i)
+            if fused is None:
+                result.append(instructions[i])
+                i += 1
+            else:
+                result.append(fused)
+                i += length
+        return result
+
+    def match(self, instructions, i):
+        first = instructions[i]
+        remaining = len(instructions) - i
+        if remaining >= 4 and first.code == bytecode.LOAD_CONST:
+            load = instructions[i + 1]
+            add = instructions[i + 2]
+            store = instructions[i + 3]
+            if load.code == bytecode.LOAD_VAR and\
+               bytecode.generic(add.code) == bytecode.ADD and\
+               store.code == bytecode.STORE_VAR and\
+               load.arg == store.arg and\
+               bytecode.packable(store.arg, first.arg):
+                return (self.fused(bytecode.INC_VAR,
+                                   bytecode.pack(store.arg, first.arg),
+                                   None, add), 4)
+        if remaining >= 2:
+            second = instructions[i + 1]
+            compared = bytecode.generic(first.code)
+            if compared in bytecode.UNLESS_VARIANT and\
+               second.code == bytecode.J_IF_FALSE:
+                return (self.fused(bytecode.UNLESS_VARIANT[compared], 0,
+                                   second.target, first), 2)
+            if compared in NEGATED and second.code == bytecode.J_IF_TRUE:
+                negated = NEGATED[compared]
+                return (self.fused(bytecode.UNLESS_VARIANT[negated], 0,
+                                   second.target, first), 2)
+            if first.code == bytecode.LOAD_VAR and first.arg != -1:
+                if second.code == bytecode.GET_INDEX:
+                    return (self.fused(bytecode.INDEX_VAR, first.arg, None,
+                                       second), 2)
+                indexed = remaining >= 3 and\
+                    instructions[i + 2].code == bytecode.GET_INDEX
+                if second.code == bytecode.LOAD_VAR and not indexed and\
+                   bytecode.packable(first.arg, second.arg):
+                    return (self.fused(bytecode.LOAD_VARS,
+                                       bytecode.pack(first.arg, second.arg),
+                                       None, first), 2)
+        return (None, 0)
+
+    # the fused opcode reports errors where the instruction that could
+    # raise them would have
+    def fused(self, code, arg, target, source):
+        return Instruction(code, arg, target, source.package, source.line,
+                           source.col)
+
+
+# -O1 runs the passes that rewrite code in place; -O2 adds the ones
+# that copy or move code around, making it bigger in exchange
+optimizer = PassManager()
+optimizer.addpass(Inlining())
+optimizer.addpass(ConstantFolding())
+optimizer.addpass(CommonSubexpressions())
+optimizer.addpass(Peephole())
+optimizer.addpass(TypeInference())
+optimizer.addpass(LoopInvariantMotion())
+optimizer.addpass(Superinstructions())
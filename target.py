@@ -6,10 +6,12 @@
 
 from rpython.jit.codewriter.policy import JitPolicy
 from rpython.rlib.streamio import open_file_as_stream
-from soda.interpreter import interpret
+from soda.interpreter import interpret, MAXDEPTH
 from soda.parser import parser
 from soda.bytecode import compile_ast
 from soda.fetcher import fetcher
+from soda.optimizer import optimizer
+from soda.objects import utf8length
 import os
 import sys
 
@@ -18,6 +20,7 @@ def main(argv):
     isdump = False
     norun = False
     sourcefound = False
+    maxdepth = MAXDEPTH
     extrafiles = []
     for arg in argv:
         if arg.startswith("-"):
@@ -25,6 +28,18 @@ def main(argv):
                 isdump = True
             elif arg == "--norun":
                 norun = True
+            elif arg.startswith("--maxdepth="):
+                try:
+                    maxdepth = int(arg[len("--maxdepth="):])
+                except ValueError:
+                    print("invalid maximum depth %s" % arg)
+                    os._exit(-1)
+            elif arg.startswith("-O"):
+                if arg == "-O0" or arg == "-O1" or arg == "-O2":
+                    optimizer.setlevel(int(arg[2:]))
+                else:
+                    print("invalid optimization level %s" % arg)
+                    os._exit(-1)
         elif arg.endswith(".na"):
             if not sourcefound:
                 sourcefound = True
@@ -37,19 +52,22 @@ def main(argv):
     if sourcefound:
         bc = compile_ast(parser.parse(fetcher.gettokens()))
         if isdump:
-            print(bc.dump())
+            print(bc.dump() + bc.dumpfunctions())
         if not norun:
             if extrafiles == []:
                 bc.create_arrays("")
-                interpret(bc)
+                interpret(bc, maxdepth)
             else:
                 for filepath in extrafiles:
                     try:
                         sourcefile = open_file_as_stream(filepath)
                         data = sourcefile.readall()
                         sourcefile.close()
+                        if utf8length(data) == -1:
+                            print("file %s is not valid UTF-8" % filepath)
+                            os._exit(-1)
                         bc.create_arrays(data)
-                        interpret(bc)
+                        interpret(bc, maxdepth)
                     except OSError:
                         print("file %s not found" % filepath)
                         os._exit(-1)